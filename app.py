@@ -1,23 +1,48 @@
 # app.py
 import os
+import re
+import shutil
+import html
+import asyncio
+import functools
+import hashlib
+import hmac
 import uuid
 import json
+import time
+import sqlite3
+import mimetypes
+import multiprocessing
 import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import date, datetime, timedelta
-from typing import Dict, List, Tuple, Optional
+from urllib.parse import parse_qsl, quote
+from typing import DefaultDict, Dict, List, Set, Tuple, Optional
 
 import requests
 from icalendar import Calendar
-from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException, Cookie
-from fastapi.responses import HTMLResponse, PlainTextResponse, FileResponse, RedirectResponse
+from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException, Cookie, Depends
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 
 # Optional DB + image libs
 try:
     import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
 except Exception:
     psycopg2 = None
 
+# RRULE expansion for recurring VEVENTs (optional)
+try:
+    import recurring_ical_events
+except Exception:
+    recurring_ical_events = None
+
 # HEIC -> JPG conversion (optional)
 try:
     from PIL import Image
@@ -40,6 +65,16 @@ CLEAN_END = os.getenv("CLEAN_END", "16:00")
 # Login
 APP_PASSWORD = (os.getenv("APP_PASSWORD") or "").strip()
 SESSION_COOKIE = "cleaner_auth"
+SESSION_MAX_AGE = 60 * 60 * 12
+# Session cookies are signed with a key derived from APP_PASSWORD, so every worker and restart
+# accepts them and changing the password logs everyone out. SESSION_SECRET (optional) is mixed in
+# to keep the key unguessable even if the password is weak.
+SESSION_SECRET = (os.getenv("SESSION_SECRET") or "").strip()
+
+def _session_key(password: str, secret: str) -> bytes:
+    return hmac.new(password.encode(), b"session:" + secret.encode(), hashlib.sha256).digest()
+
+_SESSION_KEY = _session_key(APP_PASSWORD, SESSION_SECRET)
 
 # Counter admin PIN
 COUNTER_PASSWORD = (os.getenv("COUNTER_PASSWORD") or "").strip()
@@ -58,34 +93,58 @@ DATABASE_URL = (os.getenv("DATABASE_URL") or "").strip()
 
 # Upload dirs
 UPLOAD_DIR = "/tmp/uploads"          # actual image files (publicly served)
-MARK_DIR = "/tmp/marks"              # file fallback markers
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(MARK_DIR, exist_ok=True)
-
-# ======== File counter fallback (kept, but DB will override) ========
-COUNTER_FILE = os.getenv("COUNTER_FILE", "/tmp/clean_counter.json")
-COUNTER_LOCK = threading.Lock()
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "1600"))   # converted HEIC photos are scaled down to fit
 
-def _ensure_counter_file():
-    if not os.path.exists(COUNTER_FILE):
-        with open(COUNTER_FILE, "w") as f:
-            json.dump({"count": 0}, f)
-
-def _read_counter_value() -> int:
-    _ensure_counter_file()
-    try:
-        with open(COUNTER_FILE, "r") as f:
-            return int(json.load(f).get("count", 0))
-    except Exception:
-        return 0
-
-def _write_counter_value(v: int):
-    try:
-        with open(COUNTER_FILE, "w") as f:
-            json.dump({"count": max(0, int(v))}, f)
-    except Exception:
-        pass
-# =========================================================
+# ---------------------------
+# Local SQLite store (WAL: readers don't block the writer, rows survive restarts)
+# ---------------------------
+LOCAL_DB_FILE = os.getenv("LOCAL_DB_FILE", "/tmp/cleaner.db")
+_LOCAL = threading.local()
+
+def _local_db() -> sqlite3.Connection:
+    """Per-thread connection in autocommit mode."""
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(LOCAL_DB_FILE, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _LOCAL.conn = conn
+    return conn
+
+def _local_db_init() -> None:
+    db = _local_db()
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS wa_queue (
+            id INTEGER PRIMARY KEY,
+            caption TEXT NOT NULL,
+            media_urls TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    if "attempts" not in {row[1] for row in db.execute("PRAGMA table_info(wa_queue)")}:
+        db.execute("ALTER TABLE wa_queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    # Fallback completion marks and counter, used when Postgres is unavailable
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS marks (
+            flat TEXT NOT NULL,
+            day TEXT NOT NULL,
+            PRIMARY KEY (flat, day)
+        ) WITHOUT ROWID
+    """)
+    db.execute("CREATE TABLE IF NOT EXISTS counter (id INTEGER PRIMARY KEY CHECK (id = 1), v INTEGER NOT NULL)")
+    db.execute("INSERT OR IGNORE INTO counter(id, v) VALUES (1, 0)")
+    # Changes on every marks write from any worker process (see marks_stamp)
+    db.execute("CREATE TABLE IF NOT EXISTS marks_version (id INTEGER PRIMARY KEY CHECK (id = 1), v INTEGER NOT NULL)")
+    db.execute("INSERT OR IGNORE INTO marks_version(id, v) VALUES (1, 0)")
+    for event in ("INSERT", "DELETE"):
+        db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS marks_{event.lower()}_version AFTER {event} ON marks
+            BEGIN UPDATE marks_version SET v = v + 1 WHERE id = 1; END
+        """)
+
+_local_db_init()
 
 # Optional Twilio import
 try:
@@ -98,19 +157,107 @@ except Exception:
 # App
 # ---------------------------
 app = FastAPI(title="Cleaner Schedule")
-app.mount("/static", StaticFiles(directory=UPLOAD_DIR), name="static")
+# StaticFiles picks Content-Type from the extension; not every host's mime table knows these
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/heic", ".heic")
+# Everything under /static is content-addressed (uuid uploads, hashed CSS name), so it never changes
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers and proxies reuse what it serves."""
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers.setdefault("Cache-Control", STATIC_CACHE_CONTROL)
+        return resp
+
+app.mount("/static", CachedStaticFiles(directory=UPLOAD_DIR), name="static")
+# Legacy media URLs (new uploads link to /static/...); kept so already-queued links still resolve
+app.mount("/m", CachedStaticFiles(directory=UPLOAD_DIR), name="media")
+
+# Photos are already compressed; gzipping them only burns CPU
+_NO_GZIP_EXT = (".jpg", ".jpeg", ".png", ".webp", ".heic")
+
+class GZipExceptImages:
+    """GZip for pages/CSS/text, with photo downloads passed straight through."""
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].lower().endswith(_NO_GZIP_EXT):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(GZipExceptImages, minimum_size=1024)
+
+# Starlette spools a whole multipart body to a temp file before the handler runs, so the size
+# limit has to be enforced while the body is received, not when the photos are copied.
+MAX_REQUEST_BYTES = int(os.getenv("MAX_UPLOAD_MB", "100")) << 20
+
+class RequestSizeLimit:
+    """413 for bodies over max_bytes: up front from Content-Length, or once the stream passes it."""
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.max_bytes:
+            return await PlainTextResponse("Upload too large", status_code=413)(scope, receive, send)
+        seen = 0
+
+        async def limited_receive():
+            nonlocal seen
+            message = await receive()
+            seen += len(message.get("body", b""))
+            if seen > self.max_bytes:
+                raise HTTPException(status_code=413, detail="Upload too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(RequestSizeLimit, max_bytes=MAX_REQUEST_BYTES)
 
 # ---------------------------
 # Auth helpers
 # ---------------------------
+def _session_sig(expires: str) -> str:
+    return hmac.new(_SESSION_KEY, expires.encode(), hashlib.sha256).hexdigest()
+
+def make_session_token() -> str:
+    """'<expiry>.<hmac>' - the cookie proves a login without carrying the password."""
+    expires = str(int(time.time()) + SESSION_MAX_AGE)
+    return f"{expires}.{_session_sig(expires)}"
+
 def check_auth(session_token: Optional[str]) -> bool:
-    return bool(APP_PASSWORD) and (session_token == APP_PASSWORD)
+    if not APP_PASSWORD or not session_token:
+        return False
+    expires, _, sig = session_token.partition(".")
+    if not expires.isdigit() or not hmac.compare_digest(sig.encode(), _session_sig(expires).encode()):
+        return False
+    return int(expires) > time.time()
+
+def require_auth(session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)) -> None:
+    if not check_auth(session_token):
+        raise HTTPException(status_code=303, headers={"Location": "/login"})
+
+def check_pin(pin: str) -> bool:
+    """Admin actions need COUNTER_PASSWORD when one is set."""
+    return not COUNTER_PASSWORD or hmac.compare_digest(pin.encode(), COUNTER_PASSWORD.encode())
+
+# Attach to protected routes: dependencies=AUTH
+AUTH = [Depends(require_auth)]
 
 # ---------------------------
 # Flats & ICS helpers
 # ---------------------------
 PALETTE = ["#FF9800", "#2196F3", "#4CAF50", "#9C27B0", "#E91E63", "#00BCD4", "#795548", "#3F51B5"]
 
+# Env is fixed for the life of the process, so the flats are read once; treat the result as read-only
+@functools.lru_cache(maxsize=1)
 def load_flats(max_flats: int = 50) -> Dict[str, Dict[str, str]]:
     flats: Dict[str, Dict[str, str]] = {}
     i = 0
@@ -121,31 +268,93 @@ def load_flats(max_flats: int = 50) -> Dict[str, Dict[str, str]]:
         name = (os.getenv(f"FLAT{n}_NAME") or f"Flat {n}").strip()
         nick = (os.getenv(f"FLAT{n}_NICK") or name).strip()
         colour = (os.getenv(f"FLAT{n}_COLOUR") or PALETTE[i % len(PALETTE)]).strip()
-        flats[name] = {"url": url, "nick": nick, "colour": colour}
+        flats[name] = {
+            "url": url,
+            "nick": nick,
+            "colour": colour,
+            "quoted": quote(name, safe=""),
+            # schedule-row chip; fixed per flat, so escaped and formatted once here
+            "chip": f'<span class="pill"><span class="dot" style="background:{html.escape(colour)}"></span>{html.escape(nick)}</span>',
+        }
         i += 1
     return flats
 
 UA_HEADERS = {"User-Agent": "CleanerSchedule/1.0 (+https://example.com)"}
+ICS_FETCH_WORKERS = 8
 
-def fetch_ics(url: str) -> str:
+# One keep-alive session for all feed fetches: flats usually share a host, so later
+# fetches skip the TCP/TLS handshake. Pool sized so every fetch worker can hold a connection.
+_HTTP = requests.Session()
+_HTTP.headers.update(UA_HEADERS)
+_HTTP.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=ICS_FETCH_WORKERS))
+_HTTP.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=ICS_FETCH_WORKERS))
+
+def fetch_ics(url: str, headers: Optional[Dict[str, str]] = None) -> Optional[requests.Response]:
     if not url:
-        return ""
+        return None
     try:
-        r = requests.get(url, headers=UA_HEADERS, timeout=10)
-        if r.status_code >= 400 or not r.text:
-            return ""
-        return r.text
+        return _HTTP.get(url, headers=headers, timeout=10)
     except Exception:
-        return ""
+        return None
+
+_ICS_DATE_RE = re.compile(r"(\d{4})(\d{2})(\d{2})")
+_ICS_FOLD_RE = re.compile(r"\r?\n[ \t]")
+
+def parse_bookings_fast(ics_text: str) -> Optional[List[Tuple[date, date]]]:
+    """
+    Scan VEVENT blocks for DTSTART/DTEND lines without building the icalendar object model.
+    Returns None on anything unfamiliar so the caller can fall back to icalendar.
+    """
+    spans: List[Tuple[date, date]] = []
+    in_ev = False
+    ci = co = None
+    if "\n " in ics_text or "\n\t" in ics_text:
+        # RFC 5545 folding: a CRLF followed by one space/tab continues the previous line
+        ics_text = _ICS_FOLD_RE.sub("", ics_text)
+    for line in ics_text.splitlines():
+        if line.startswith("BEGIN:VEVENT"):
+            in_ev = True
+            ci = co = None
+        elif not in_ev:
+            continue
+        elif line.startswith("END:VEVENT"):
+            if ci and co:
+                spans.append((ci, co))
+            in_ev = False
+        elif line.startswith(("RRULE", "RDATE")):
+            return None  # recurring event: needs expanding
+        elif line.startswith(("DTSTART", "DTEND")):
+            # value is after the last ':' (params like TZID=... come before it);
+            # the first 8 digits are the local date, same as icalendar's .dt.date()
+            m = _ICS_DATE_RE.match(line.rpartition(":")[2])
+            if not m:
+                return None
+            try:
+                d = date(int(m[1]), int(m[2]), int(m[3]))
+            except ValueError:
+                return None
+            if line.startswith("DTSTART"):
+                ci = d
+            else:
+                co = d
+    if in_ev:
+        return None
+    return spans
+
+RECUR_PAST_DAYS = 31
+RECUR_AHEAD_DAYS = 366
 
 def parse_bookings(ics_text: str) -> List[Tuple[date, date]]:
     if not ics_text.strip():
         return []
+    spans = parse_bookings_fast(ics_text)
+    if spans is not None:
+        return spans
     try:
         cal = Calendar.from_ical(ics_text)
     except Exception:
         return []
-    spans: List[Tuple[date, date]] = []
+    spans = []
     def to_date(v) -> Optional[date]:
         try:
             if hasattr(v, "dt"):
@@ -153,9 +362,16 @@ def parse_bookings(ics_text: str) -> List[Tuple[date, date]]:
             return v.date() if isinstance(v, datetime) else v
         except Exception:
             return None
-    for comp in cal.walk():
-        if getattr(comp, "name", None) != "VEVENT":
-            continue
+    events = cal.walk("VEVENT")
+    if recurring_ical_events is not None and any(ev.get("RRULE") or ev.get("RDATE") for ev in events):
+        # Expand repeats into one occurrence each, over a window wide enough for any ?days= view
+        today = datetime.utcnow().date()
+        try:
+            events = recurring_ical_events.of(cal).between(today - timedelta(days=RECUR_PAST_DAYS),
+                                                           today + timedelta(days=RECUR_AHEAD_DAYS))
+        except Exception as e:
+            print("RRULE expansion failed, using base events:", repr(e))
+    for comp in events:
         ds = comp.get("DTSTART"); de = comp.get("DTEND")
         if not ds or not de:
             continue
@@ -164,246 +380,479 @@ def parse_bookings(ics_text: str) -> List[Tuple[date, date]]:
             spans.append((ci, co))
     return spans
 
+# Parsed feeds per URL (url -> (checked_at, etag, last_modified, spans)). Within ICS_TTL seconds the
+# cached spans are used as-is; after that the feed is revalidated with If-None-Match / If-Modified-Since.
+# A feed that just failed is not retried for ICS_FAIL_RETRY seconds so a dead URL doesn't stall every render;
+# meanwhile its last good spans are served (or nothing, if it has never loaded).
+ICS_TTL = float(os.getenv("ICS_TTL", "120"))
+ICS_FAIL_RETRY = 60.0
+_ICS_CACHE: Dict[str, Tuple[float, str, str, List[Tuple[date, date]]]] = {}
+_ICS_FAILED: Dict[str, float] = {}
+# Bumped whenever a feed's contents (as shown on /cleaner) change. Feeds are fetched per process,
+# so a per-process counter is enough; bumps come from several threads, hence the lock.
+_versions = {"ics": 0}
+_VERSIONS_LOCK = threading.Lock()
+
+def _bump_version(kind: str) -> None:
+    with _VERSIONS_LOCK:
+        _versions[kind] += 1
+
+_ICS_LOCKS: Dict[str, threading.Lock] = {}
+
+def _fresh_spans(url: str) -> Optional[List[Tuple[date, date]]]:
+    """Spans that can be served without a request, or None if the feed needs (re)fetching."""
+    now = time.monotonic()
+    cached = _ICS_CACHE.get(url)
+    if cached and now - cached[0] < ICS_TTL:
+        return cached[3]
+    failed_at = _ICS_FAILED.get(url)
+    if failed_at is not None and now - failed_at < ICS_FAIL_RETRY:
+        return cached[3] if cached else []
+    return None
+
+def get_spans(url: str) -> List[Tuple[date, date]]:
+    if not url:
+        return []
+    spans = _fresh_spans(url)
+    if spans is not None:
+        return spans
+    # One fetch per URL at a time: concurrent renders that find the entry expired
+    # wait for the first one's result instead of all hitting the feed
+    with _ICS_LOCKS.setdefault(url, threading.Lock()):
+        spans = _fresh_spans(url)
+        if spans is not None:
+            return spans
+        return _refetch_spans(url)
+
+def _feed_recovered(url: str) -> None:
+    # A page rendered while the feed was down may be cached without its bookings;
+    # re-render even if the feed comes back unchanged (304 / same spans)
+    if _ICS_FAILED.pop(url, None) is not None:
+        _bump_version("ics")
+
+def _refetch_spans(url: str) -> List[Tuple[date, date]]:
+    cached = _ICS_CACHE.get(url)
+    headers = {}
+    if cached and cached[1]:
+        headers["If-None-Match"] = cached[1]
+    if cached and cached[2]:
+        headers["If-Modified-Since"] = cached[2]
+    r = fetch_ics(url, headers)
+    if r is not None and r.status_code == 304 and cached:
+        _ICS_CACHE[url] = (time.monotonic(), cached[1], cached[2], cached[3])
+        _feed_recovered(url)
+        return cached[3]
+    if r is None or r.status_code >= 400 or not r.content:
+        # one timeout shouldn't blank the flat's bookings; keep showing the last good copy
+        _ICS_FAILED[url] = time.monotonic()
+        if cached:
+            return cached[3]
+        _bump_version("ics")
+        return []
+    # iCalendar is UTF-8 by spec (RFC 5545 3.1.4); decoding the bytes directly skips requests'
+    # charset sniffing over the whole body when the server leaves charset off the Content-Type
+    spans = parse_bookings(r.content.decode("utf-8", "replace"))
+    if not cached or cached[3] != spans:
+        _bump_version("ics")
+    _ICS_CACHE[url] = (time.monotonic(), r.headers.get("ETag", ""), r.headers.get("Last-Modified", ""), spans)
+    _feed_recovered(url)
+    return spans
+
+def spans_by_url(flats: Dict[str, Dict[str, str]]) -> Dict[str, List[Tuple[date, date]]]:
+    # Flats can share one feed (e.g. a channel-manager export); fetch each URL once
+    urls = list(dict.fromkeys(meta["url"] for meta in flats.values()))
+    return dict(zip(urls, ICS_POOL.map(get_spans, urls)))
+
+def refresh_feeds() -> None:
+    """Revalidate any expired feeds (bumping _versions["ics"] if one changed)."""
+    spans_by_url(load_flats())
+
+# Feeds are fetched side by side; a render waits for the slowest feed, not the sum of all of them
+ICS_POOL = ThreadPoolExecutor(max_workers=ICS_FETCH_WORKERS)
+
+# Revalidate feeds in the background more often than ICS_TTL, so a page view normally finds every
+# feed fresh and never waits on the calendar host. 0 turns it off (feeds then refresh on page views).
+FEED_REFRESH_SECONDS = float(os.getenv("FEED_REFRESH_SECONDS", str(ICS_TTL / 2)))
+_bg_tasks: Set[asyncio.Task] = set()
+
+async def _feed_refresh_loop() -> None:
+    while True:
+        try:
+            await run_in_threadpool(refresh_feeds)
+        except Exception as e:
+            print("Background feed refresh failed:", repr(e))
+        await asyncio.sleep(FEED_REFRESH_SECONDS)
+
+@app.on_event("startup")
+async def _start_feed_refresh() -> None:
+    if FEED_REFRESH_SECONDS > 0:
+        _bg_tasks.add(asyncio.create_task(_feed_refresh_loop()))
+
+@app.on_event("shutdown")
+async def _stop_feed_refresh() -> None:
+    for task in _bg_tasks:
+        task.cancel()
+    _bg_tasks.clear()
+
 def build_schedule(days: int, start: Optional[date] = None) -> Dict[date, List[Dict]]:
     flats = load_flats()
     if start is None:
         start = datetime.utcnow().date()
     end = start + timedelta(days=days - 1)
-    schedule: Dict[date, List[Dict]] = {}
+    feeds = spans_by_url(flats)
+    by_day: DefaultDict[date, List[Dict]] = defaultdict(list)
     for flat_name, meta in flats.items():
-        spans = parse_bookings(fetch_ics(meta["url"]))
-        per_day: Dict[date, Dict[str, bool]] = {}
+        spans = feeds[meta["url"]]
+        per_day: DefaultDict[date, Dict[str, bool]] = defaultdict(lambda: {"in": False, "out": False})
         for (ci, co) in spans:
             if start <= ci <= end:
-                per_day.setdefault(ci, {"in": False, "out": False})
                 per_day[ci]["in"] = True
             if start <= co <= end:
-                per_day.setdefault(co, {"in": False, "out": False})
                 per_day[co]["out"] = True
         for d, flags in per_day.items():
-            schedule.setdefault(d, [])
-            schedule[d].append({
+            by_day[d].append({
                 "flat": flat_name,
                 "nick": meta["nick"],
                 "colour": meta["colour"],
-                "in": bool(flags.get("in")),
-                "out": bool(flags.get("out")),
+                "quoted": meta["quoted"],
+                "chip": meta["chip"],
+                "in": flags["in"],
+                "out": flags["out"],
             })
-    schedule = dict(sorted(schedule.items(), key=lambda kv: kv[0]))
-    for day in list(schedule.keys()):
-        schedule[day].sort(key=lambda it: (not it["out"], it["flat"].lower()))
+    # check-outs first, then by name; lower-case each flat name once, not per item
+    name_keys = {name: name.lower() for name in flats}
+    schedule: Dict[date, List[Dict]] = {}
+    for d in sorted(by_day):
+        items = by_day[d]
+        items.sort(key=lambda it: (not it["out"], name_keys[it["flat"]]))
+        schedule[d] = items
     return schedule
 
 # ---------------------------
-# DB-backed completion markers + counter (with file fallback)
+# DB-backed completion markers + counter (with local SQLite fallback)
 # ---------------------------
-def _pg_conn():
+# Circuit breaker: after a run of failed connects, skip the DB for a while so every
+# call goes straight to the local fallback instead of waiting on a dead server.
+DB_BREAKER_FAILS = 3
+DB_BREAKER_COOLDOWN = 30.0   # seconds
+_DB_BREAKER = {"fail": 0, "open_until": 0.0}
+
+# Connections are pooled so each helper call is a checkout, not a new TCP+TLS+auth handshake.
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+_PG_POOL = None
+_PG_POOL_LOCK = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it is exhausted; make callers wait for a slot
+_PG_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def _pg_pool():
+    global _PG_POOL
+    if _PG_POOL is None:
+        with _PG_POOL_LOCK:
+            if _PG_POOL is None:
+                _PG_POOL = ThreadedConnectionPool(minconn=1, maxconn=DB_POOL_MAX, dsn=DATABASE_URL)
+    return _PG_POOL
+
+@contextmanager
+def _pg_conn(fresh: bool = False):
+    """
+    Borrow an autocommit connection from the pool; it is discarded if the block raises.
+    fresh=True opens a new connection instead, closed afterwards (see _pg_exec).
+    """
     if not psycopg2 or not DATABASE_URL:
         raise RuntimeError("DB not available")
-    return psycopg2.connect(DATABASE_URL)
+    if time.monotonic() < _DB_BREAKER["open_until"]:
+        raise RuntimeError("DB breaker open")
+    with _PG_SLOTS:
+        try:
+            pool = _pg_pool()
+            conn = psycopg2.connect(DATABASE_URL) if fresh else pool.getconn()
+        except Exception:
+            _DB_BREAKER["fail"] += 1
+            if _DB_BREAKER["fail"] >= DB_BREAKER_FAILS:
+                _DB_BREAKER["open_until"] = time.monotonic() + DB_BREAKER_COOLDOWN
+            raise
+        _DB_BREAKER["fail"] = 0
+        ok = False
+        try:
+            if not conn.autocommit:
+                conn.autocommit = True
+            yield conn
+            ok = True
+        finally:
+            if fresh:
+                conn.close()
+            else:
+                pool.putconn(conn, close=not ok)
+
+# What a pooled connection that died while idle (server restart, idle timeout) raises on first use
+_PG_STALE = (psycopg2.OperationalError, psycopg2.InterfaceError) if psycopg2 else ()
+
+def _pg_exec(sql: str, params: Optional[tuple] = None, fetch: Optional[str] = None):
+    """
+    Run one statement; fetch="one"/"all" returns cur.fetchone()/fetchall().
+    If the pooled connection turns out to be dead it is dropped and the statement is
+    retried once on a fresh connection, rather than failing over to the local store.
+    """
+    for fresh in (False, True):
+        try:
+            with _pg_conn(fresh) as conn, conn.cursor() as cur:
+                cur.execute(sql, params)
+                if fetch == "one":
+                    return cur.fetchone()
+                if fetch == "all":
+                    return cur.fetchall()
+                return None
+        except _PG_STALE as e:
+            if fresh:
+                raise
+            print("DB connection dropped, retrying on a fresh one:", repr(e))
 
 def _db_init() -> bool:
     try:
-        conn = _pg_conn()
-        conn.autocommit = True
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS completed_cleans (
-                    flat TEXT NOT NULL,
-                    day  DATE NOT NULL,
-                    created_at TIMESTAMPTZ DEFAULT NOW(),
-                    PRIMARY KEY (flat, day)
-                );
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS counter_offset (
-                    id INTEGER PRIMARY KEY CHECK (id = 1),
-                    clean_offset INTEGER NOT NULL DEFAULT 0
-                );
-            """)
-            cur.execute("INSERT INTO counter_offset (id, clean_offset) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;")
-        conn.close()
+        _pg_exec("""
+            CREATE TABLE IF NOT EXISTS completed_cleans (
+                flat TEXT NOT NULL,
+                day  DATE NOT NULL,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                PRIMARY KEY (flat, day)
+            );
+        """)
+        # PK leads with flat; day-range lookups need day first (also covers day-only scans)
+        _pg_exec("CREATE INDEX IF NOT EXISTS idx_completed_cleans_day_flat ON completed_cleans(day, flat);")
+        _pg_exec("""
+            CREATE TABLE IF NOT EXISTS counter_offset (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                clean_offset INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        _pg_exec("INSERT INTO counter_offset (id, clean_offset) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;")
         return True
     except Exception as e:
-        print("DB init failed, using file fallback:", repr(e))
+        print("DB init failed, using local SQLite fallback:", repr(e))
         return False
 
 USE_DB = _db_init()
 
-def mark_path(flat: str, day_iso: str) -> str:
-    safe_flat = flat.replace("/", "_").replace("\\", "_").replace(" ", "_")
-    return os.path.join(MARK_DIR, f"{day_iso}__{safe_flat}.done")
-
 def _db_completed_count() -> int:
-    conn = _pg_conn()
-    with conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM completed_cleans;")
-        n = int(cur.fetchone()[0])
-    conn.close()
-    return n
+    return int(_pg_exec("SELECT COUNT(*) FROM completed_cleans;", fetch="one")[0])
 
 def _db_get_offset() -> int:
-    conn = _pg_conn()
-    with conn.cursor() as cur:
-        cur.execute("SELECT clean_offset FROM counter_offset WHERE id=1;")
-        row = cur.fetchone()
-        val = int(row[0]) if row else 0
-    conn.close()
-    return val
+    row = _pg_exec("SELECT clean_offset FROM counter_offset WHERE id=1;", fetch="one")
+    return int(row[0]) if row else 0
 
 def _db_set_offset(v: int) -> None:
-    conn = _pg_conn()
-    conn.autocommit = True
-    with conn.cursor() as cur:
-        cur.execute("UPDATE counter_offset SET clean_offset=%s WHERE id=1;", (int(v),))
-    conn.close()
+    _pg_exec("UPDATE counter_offset SET clean_offset=%s WHERE id=1;", (int(v),))
 
-def is_completed(flat: str, day_iso: str) -> bool:
+def completed_for(pairs: List[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+    """Returns the (flat, day_iso) pairs that are marked done."""
+    if not pairs:
+        return set()
     if USE_DB:
         try:
-            conn = _pg_conn()
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1 FROM completed_cleans WHERE flat=%s AND day=%s", (flat, day_iso))
-                found = cur.fetchone() is not None
-            conn.close()
-            return found
+            days = sorted({day for _, day in pairs})
+            rows = _pg_exec("SELECT flat, day FROM completed_cleans WHERE day = ANY(%s::date[])", (days,), "all")
+            done = {(flat, day.isoformat()) for flat, day in rows}
+            return done.intersection(pairs)
         except Exception as e:
-            print("DB is_completed error, fallback:", repr(e))
-    return os.path.exists(mark_path(flat, day_iso))
+            print("DB completed_for error, fallback:", repr(e))
+    days = sorted({day for _, day in pairs})
+    rows = _local_db().execute(
+        f"SELECT flat, day FROM marks WHERE day IN ({','.join('?' * len(days))})", days
+    ).fetchall()
+    return set(rows).intersection(pairs)
 
 def set_completed(flat: str, day_iso: str) -> None:
     if USE_DB:
         try:
-            conn = _pg_conn()
-            conn.autocommit = True
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO completed_cleans(flat, day) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                    (flat, day_iso),
-                )
-            conn.close()
+            _pg_exec("INSERT INTO completed_cleans(flat, day) VALUES (%s, %s) ON CONFLICT DO NOTHING", (flat, day_iso))
+            _invalidate_counter()
             return
         except Exception as e:
             print("DB set_completed error, fallback:", repr(e))
-    try:
-        with open(mark_path(flat, day_iso), "w") as f:
-            f.write("ok")
-    except Exception:
-        pass
+    _local_db().execute("INSERT OR IGNORE INTO marks(flat, day) VALUES (?, ?)", (flat, day_iso))
+
+def marks_stamp() -> tuple:
+    """
+    Changes whenever completion marks change, whichever worker process wrote them,
+    so a cached /cleaner page can't outlive a mark made elsewhere.
+    """
+    if USE_DB:
+        try:
+            # a delete lowers the count; an insert raises the newest created_at
+            return tuple(_pg_exec("SELECT COUNT(*), MAX(created_at) FROM completed_cleans", fetch="one"))
+        except Exception as e:
+            print("DB marks_stamp error, fallback:", repr(e))
+    return (_local_db().execute("SELECT v FROM marks_version WHERE id=1").fetchone()[0],)
+
+def _db_counter_total() -> int:
+    row = _pg_exec(
+        "SELECT (SELECT COUNT(*) FROM completed_cleans)"
+        " + COALESCE((SELECT clean_offset FROM counter_offset WHERE id=1), 0);",
+        fetch="one",
+    )
+    return int(row[0])
+
+# The counter badge is on every page; serve it from memory for a couple of seconds.
+# Every write that changes the count calls _invalidate_counter() afterwards.
+COUNTER_TTL = 2.0
+_counter_cache = {"v": 0, "t": 0.0}
+
+def _invalidate_counter() -> None:
+    _counter_cache["t"] = 0.0
 
 def get_counter() -> int:
+    now = time.monotonic()
+    if now - _counter_cache["t"] < COUNTER_TTL:
+        return _counter_cache["v"]
+    v = None
     if USE_DB:
         try:
-            return _db_completed_count() + _db_get_offset()
+            v = _db_counter_total()
         except Exception as e:
             print("DB get_counter error, fallback:", repr(e))
-    with COUNTER_LOCK:
-        return _read_counter_value()
+    if v is None:
+        v = _local_db().execute("SELECT v FROM counter WHERE id=1").fetchone()[0]
+    _counter_cache["v"] = v
+    _counter_cache["t"] = now
+    return v
 
 def set_counter(v: int) -> int:
     if USE_DB:
         try:
             completed = _db_completed_count()
             _db_set_offset(int(v) - completed)
+            _invalidate_counter()
             return get_counter()
         except Exception as e:
             print("DB set_counter error:", repr(e))
             return get_counter()
-    with COUNTER_LOCK:
-        _write_counter_value(v)
-        return v
+    v = max(0, int(v))
+    _local_db().execute("UPDATE counter SET v=? WHERE id=1", (v,))
+    _invalidate_counter()
+    return v
 
 def bump_counter(delta: int = 1) -> int:
     if USE_DB:
         try:
             _db_set_offset(_db_get_offset() + int(delta))
+            _invalidate_counter()
             return get_counter()
         except Exception as e:
             print("DB bump_counter error:", repr(e))
             return get_counter()
-    with COUNTER_LOCK:
-        c = _read_counter_value()
-        c = max(0, c + int(delta))
-        _write_counter_value(c)
-        return c
+    # single UPDATE, so concurrent bumps from other threads/workers can't lose an increment
+    db = _local_db()
+    db.execute("UPDATE counter SET v=max(0, v + ?) WHERE id=1", (int(delta),))
+    _invalidate_counter()
+    return db.execute("SELECT v FROM counter WHERE id=1").fetchone()[0]
 
 # ----- helpers to delete completed marks -----
 def clear_completed(day_iso: Optional[str] = None, flat: Optional[str] = None):
     """
-    Delete completion markers from DB or files.
+    Delete completion markers from Postgres, or the local SQLite fallback.
       - If day_iso only -> clears all flats on that day.
       - If day_iso + flat -> clears one flat on that day.
       - If neither -> clears everything (danger!).
     """
     if USE_DB:
         try:
-            conn = _pg_conn()
-            conn.autocommit = True
-            with conn.cursor() as cur:
-                if day_iso and flat:
-                    cur.execute("DELETE FROM completed_cleans WHERE day=%s AND flat=%s", (day_iso, flat))
-                elif day_iso:
-                    cur.execute("DELETE FROM completed_cleans WHERE day=%s", (day_iso,))
-                else:
-                    cur.execute("DELETE FROM completed_cleans")
-            conn.close()
+            if day_iso and flat:
+                _pg_exec("DELETE FROM completed_cleans WHERE day=%s AND flat=%s", (day_iso, flat))
+            elif day_iso:
+                _pg_exec("DELETE FROM completed_cleans WHERE day=%s", (day_iso,))
+            else:
+                _pg_exec("DELETE FROM completed_cleans")
+            _invalidate_counter()
             return
         except Exception as e:
             print("DB clear_completed error, fallback:", repr(e))
 
-    # file fallback
-    try:
-        if day_iso and flat:
-            safe_flat = flat.replace("/", "_").replace("\\", "_").replace(" ", "_")
-            p = os.path.join(MARK_DIR, f"{day_iso}__{safe_flat}.done")
-            if os.path.exists(p):
-                os.remove(p)
-        elif day_iso:
-            for fname in os.listdir(MARK_DIR):
-                if fname.startswith(f"{day_iso}__") and fname.endswith(".done"):
-                    os.remove(os.path.join(MARK_DIR, fname))
-        else:
-            for fname in os.listdir(MARK_DIR):
-                if fname.endswith(".done"):
-                    os.remove(os.path.join(MARK_DIR, fname))
-    except Exception as e:
-        print("File clear_completed error:", repr(e))
+    db = _local_db()
+    if day_iso and flat:
+        db.execute("DELETE FROM marks WHERE day=? AND flat=?", (day_iso, flat))
+    elif day_iso:
+        db.execute("DELETE FROM marks WHERE day=?", (day_iso,))
+    else:
+        db.execute("DELETE FROM marks")
 
 # ---------------------------
 # WhatsApp helpers (freeform + template + queue)
 # ---------------------------
-PHOTO_QUEUE_FILE = "/tmp/photo_queue.json"
+WA_SEND_WORKERS = 4   # small fan-out so media sends overlap without tripping Twilio rate limits
 QUEUE_LOCK = threading.Lock()
+# A queued item that keeps failing (dead media URL, bad number...) is given up on after this many releases
+WA_QUEUE_MAX_ATTEMPTS = 5
 
 def _wa_numbers():
     from_num = TWILIO_WHATSAPP_FROM if TWILIO_WHATSAPP_FROM.startswith("whatsapp:") else f"whatsapp:{TWILIO_WHATSAPP_FROM}"
     to_num   = TWILIO_WHATSAPP_TO   if TWILIO_WHATSAPP_TO.startswith("whatsapp:")   else f"whatsapp:{TWILIO_WHATSAPP_TO}"
     return from_num, to_num
 
-def _load_queue() -> List[dict]:
-    with QUEUE_LOCK:
-        if not os.path.exists(PHOTO_QUEUE_FILE):
-            return []
+def _wa_window_closed(err: str) -> bool:
+    return "63016" in err or "outside the allowed window" in err.lower()
+
+def _wa_send_media(from_num: str, to_num: str, caption: str, media_urls: List[str],
+                   sent: Optional[List[str]] = None) -> None:
+    """
+    One message per media URL, first carries the caption. Sends run concurrently
+    (the Twilio SDK blocks on HTTP), each failure is retried once, and the first
+    remaining error is raised so callers keep their 63016 handling.
+    URLs that did go out are appended to `sent`, so a partial failure can be retried
+    without repeating them.
+    """
+    def send(idx: int, m: str):
+        print(f"Sending WA media: {m}")
+        msg = twilio_client.messages.create(from_=from_num, to=to_num, body=caption if idx == 0 else "", media_url=[m])
+        if sent is not None:
+            sent.append(m)
+        return msg
+
+    failed: List[Tuple[int, str, Exception]] = []
+    with ThreadPoolExecutor(max_workers=WA_SEND_WORKERS) as ex:
+        futures = {ex.submit(send, idx, m): (idx, m) for idx, m in enumerate(media_urls)}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                failed.append((*futures[fut], e))
+
+    errors: List[Exception] = []
+    for idx, m, e in sorted(failed, key=lambda f: f[0]):
+        if _wa_window_closed(repr(e)):
+            errors.append(e)  # retrying won't help until the user replies
+            continue
         try:
-            with open(PHOTO_QUEUE_FILE, "r") as f:
-                return json.load(f) or []
-        except Exception:
-            return []
+            send(idx, m)
+        except Exception as e2:
+            errors.append(e2)
+    if errors:
+        raise errors[0]
 
-def _save_queue(queue: List[dict]) -> None:
-    with QUEUE_LOCK:
-        with open(PHOTO_QUEUE_FILE, "w") as f:
-            json.dump(queue, f)
+def _load_queue() -> List[dict]:
+    rows = _local_db().execute("SELECT id, caption, media_urls, ts, attempts FROM wa_queue ORDER BY id").fetchall()
+    return [{"id": r[0], "caption": r[1], "media_urls": json.loads(r[2]), "ts": r[3], "attempts": r[4]} for r in rows]
+
+def _delete_queue_items(ids: List[int]) -> None:
+    _local_db().executemany("DELETE FROM wa_queue WHERE id=?", [(i,) for i in ids])
+
+def _requeue_failed(item: dict, caption: str, media_urls: List[str]) -> None:
+    """Record a failed send; after WA_QUEUE_MAX_ATTEMPTS the row is dropped so the queue can drain."""
+    attempts = item.get("attempts", 0) + 1
+    if attempts >= WA_QUEUE_MAX_ATTEMPTS:
+        print(f"Dropping queued item {item['id']} after {attempts} failed sends:", repr(caption), media_urls)
+        _delete_queue_items([item["id"]])
+        return
+    _local_db().execute("UPDATE wa_queue SET caption=?, media_urls=?, attempts=? WHERE id=?",
+                        (caption, json.dumps(media_urls), attempts, item["id"]))
+
+def _clear_queue() -> None:
+    _local_db().execute("DELETE FROM wa_queue")
 
 def _queue_item(caption: str, media_urls: List[str]) -> None:
-    item = {
-        "caption": caption,
-        "media_urls": media_urls or [],
-        "ts": datetime.utcnow().isoformat()
-    }
-    q = _load_queue()
-    q.append(item)
-    _save_queue(q)
+    _local_db().execute(
+        "INSERT INTO wa_queue(caption, media_urls, ts) VALUES (?, ?, ?)",
+        (caption, json.dumps(media_urls or []), datetime.utcnow().isoformat()),
+    )
     print(f"Queued {len(media_urls)} photos for later send.")
 
 def _release_queue_and_send():
@@ -412,26 +861,34 @@ def _release_queue_and_send():
         print("Twilio not configured; cannot release queue.")
         return
     from_num, to_num = _wa_numbers()
-    q = _load_queue()
-    if not q:
-        print("Queue empty; nothing to send.")
-        return
-    # clear first to avoid loops if send fails halfway
-    _save_queue([])
-    for item in q:
-        caption = item.get("caption", "")
-        media_urls = item.get("media_urls", [])
-        try:
-            if media_urls:
-                for idx, m in enumerate(media_urls):
-                    body = caption if idx == 0 else ""
-                    print(f"[Queue release] Sending media: {m}")
-                    twilio_client.messages.create(from_=from_num, to=to_num, body=body, media_url=[m])
-            else:
-                print("[Queue release] Sending text only.")
-                twilio_client.messages.create(from_=from_num, to=to_num, body=caption)
-        except Exception as e:
-            print("Queue release send error:", repr(e))
+    # one release at a time, so a webhook and the Release button can't send the same rows twice
+    with QUEUE_LOCK:
+        q = _load_queue()
+        if not q:
+            print("Queue empty; nothing to send.")
+            return
+        for item in q:
+            caption = item.get("caption", "")
+            media_urls = item.get("media_urls", [])
+            sent: List[str] = []
+            try:
+                if media_urls:
+                    print(f"[Queue release] Sending {len(media_urls)} media")
+                    _wa_send_media(from_num, to_num, caption, media_urls, sent)
+                else:
+                    print("[Queue release] Sending text only.")
+                    twilio_client.messages.create(from_=from_num, to=to_num, body=caption)
+            except Exception as e:
+                # row stays queued and is retried on the next release, minus whatever already went out
+                print("Queue release send error:", repr(e))
+                if sent:
+                    unsent = [m for m in media_urls if m not in sent]
+                    # the caption rides on the first photo; don't repeat it if that one was delivered
+                    _requeue_failed(item, "" if media_urls[0] in sent else caption, unsent)
+                else:
+                    _requeue_failed(item, caption, media_urls)
+                continue
+            _delete_queue_items([item["id"]])
 
 def wa_send_with_template(details_text: str) -> None:
     """Send using approved WhatsApp template (fills {{1}} with details_text)."""
@@ -451,84 +908,141 @@ def wa_send_with_template(details_text: str) -> None:
     except Exception as e:
         print("Template send error:", repr(e))
 
-def wa_send_text_and_media_or_queue(caption: str, media_urls: Optional[List[str]], details_text_for_template: str):
+def _wa_try_send(from_num: str, to_num: str, caption: str, media_urls: Optional[List[str]]) -> bool:
     """
-    Try freeform with media first. If blocked (63016), queue photos and
-    send a template asking the user to reply to open the 24h window.
+    Freeform send of one update. If blocked (63016) the photos are queued and True is
+    returned, so the caller can send a template asking the user to reply.
     """
-    if not twilio_client or not TWILIO_WHATSAPP_FROM or not TWILIO_WHATSAPP_TO:
-        print("Twilio not configured; skipping WA send.")
-        return
-
-    from_num, to_num = _wa_numbers()
-
     try:
         if media_urls:
-            # send one media per message; first carries caption
-            for idx, m in enumerate(media_urls):
-                body = caption if idx == 0 else ""
-                print(f"Sending WA media: {m}")
-                twilio_client.messages.create(from_=from_num, to=to_num, body=body, media_url=[m])
+            _wa_send_media(from_num, to_num, caption, media_urls)
         else:
             print("Sending WA text only")
             twilio_client.messages.create(from_=from_num, to=to_num, body=caption)
-
+        return False
     except Exception as e:
         err = repr(e)
         print("Twilio freeform error:", err)
-        if "63016" in err or "outside the allowed window" in err.lower():
+        if _wa_window_closed(err):
             # Queue photos for later delivery
             _queue_item(caption=caption, media_urls=media_urls or [])
-            # Include a link to the first photo (if any) in the template text for convenience
-            first_link = (media_urls[0] if media_urls else "")
-            appended = f" — View: {first_link}" if first_link else ""
-            wa_send_with_template(details_text_for_template + appended)
-        else:
-            # Unexpected error; just log it
-            print("Unexpected Twilio error (not 63016):", err)
+            return True
+        # Unexpected error; just log it
+        print("Unexpected Twilio error (not 63016):", err)
+        return False
+
+def _with_first_link(details_text: str, media_urls: Optional[List[str]]) -> str:
+    # Include a link to the first photo (if any) in the template text for convenience
+    return f"{details_text} — View: {media_urls[0]}" if media_urls else details_text
+
+def wa_send_text_and_media_or_queue(caption: str, media_urls: Optional[List[str]], details_text_for_template: str):
+    """
+    Try freeform with media first. If blocked (63016), queue photos and
+    send a template asking the user to reply to open the 24h window.
+    """
+    if not twilio_client or not TWILIO_WHATSAPP_FROM or not TWILIO_WHATSAPP_TO:
+        print("Twilio not configured; skipping WA send.")
+        return
+    from_num, to_num = _wa_numbers()
+    if _wa_try_send(from_num, to_num, caption, media_urls):
+        wa_send_with_template(_with_first_link(details_text_for_template, media_urls))
+
+# Opt-in: with WA_BATCH_SECONDS > 0, uploads within that many seconds of each other (a cleaner doing
+# several flats back to back) are sent together and share a single template if the window is closed.
+# Each upload still goes out as its own caption + photos. Pending updates live in memory only.
+WA_BATCH_SECONDS = float(os.getenv("WA_BATCH_SECONDS", "0"))
+# WhatsApp rejects template bodies over 1024 characters; leave room for the template's own text
+WA_TEMPLATE_TEXT_MAX = 900
+_WA_BATCH: List[Tuple[str, List[str], str]] = []
+_WA_BATCH_LOCK = threading.Lock()
+_wa_batch_timer: Optional[threading.Timer] = None
+
+def wa_send_batched(caption: str, media_urls: Optional[List[str]], details_text_for_template: str) -> None:
+    """Hand an upload's update off for sending; returns at once (safe to call on the event loop)."""
+    global _wa_batch_timer
+    if WA_BATCH_SECONDS <= 0:
+        IO_POOL.submit(wa_send_text_and_media_or_queue, caption, media_urls, details_text_for_template)
+        return
+    with _WA_BATCH_LOCK:
+        _WA_BATCH.append((caption, media_urls or [], details_text_for_template))
+        if _wa_batch_timer is None:
+            _wa_batch_timer = threading.Timer(WA_BATCH_SECONDS, flush_wa_batch)
+            _wa_batch_timer.daemon = True
+            _wa_batch_timer.start()
+
+def flush_wa_batch() -> None:
+    """Send everything buffered by wa_send_batched, one caption + photo group per upload."""
+    global _wa_batch_timer
+    with _WA_BATCH_LOCK:
+        batch = _WA_BATCH[:]
+        _WA_BATCH.clear()
+        if _wa_batch_timer is not None:
+            _wa_batch_timer.cancel()
+            _wa_batch_timer = None
+    if not batch:
+        return
+    if not twilio_client or not TWILIO_WHATSAPP_FROM or not TWILIO_WHATSAPP_TO:
+        print("Twilio not configured; skipping WA send.")
+        return
+    from_num, to_num = _wa_numbers()
+    queued = [_with_first_link(details, urls) for caption, urls, details in batch
+              if _wa_try_send(from_num, to_num, caption, urls or None)]
+    if queued:
+        text = " | ".join(queued)
+        if len(text) > WA_TEMPLATE_TEXT_MAX:
+            text = text[:WA_TEMPLATE_TEXT_MAX - 1] + "…"
+        wa_send_with_template(text)
+
+@app.on_event("shutdown")
+def _flush_wa_on_shutdown() -> None:
+    flush_wa_batch()
 
 def get_queue_count() -> int:
     try:
-        return len(_load_queue())
+        return int(_local_db().execute("SELECT COUNT(*) FROM wa_queue").fetchone()[0])
     except Exception:
         return 0
 
 # ---------------------------
 # HTML
 # ---------------------------
-BASE_CSS = f"""
-<style>
-  :root {{
+APP_CSS = """
+  :root {
     --red:#d32f2f; --green:#2e7d32; --muted:#6b7280;
     --card:#ffffff; --bg:#f7f7f8; --chip:#eef2ff; --accent:#111827;
-  }}
-  body {{ font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Inter,Arial; margin:24px; background:var(--bg); color:#111; }}
-  h1 {{ margin:0 0 8px }}
-  .legend {{ color:var(--muted); margin-bottom:12px }}
-  .badges {{ display:flex; gap:8px; flex-wrap:wrap; margin-bottom:12px }}
-  .counter-badge, .queue-badge {{ display:inline-flex; align-items:center; gap:8px; background:#fff; border:1px solid #eee; border-radius:12px; padding:6px 10px; font-weight:700; }}
-  .counter-badge a, .queue-badge a {{ margin-left:8px; font-weight:600; font-size:13px }}
-  .day {{ background:var(--card); border:1px solid #eee; border-radius:14px; padding:16px; margin:16px 0; box-shadow:0 2px 6px rgba(0,0,0,.04); }}
-  .day h2 {{ margin:0 0 10px; display:flex; align-items:center; gap:10px }}
-  .today {{ background:#111; color:#fff; font-size:12px; padding:3px 8px; border-radius:999px }}
-  .row {{ display:flex; align-items:center; gap:12px; padding:10px 0; border-top:1px dashed #eee }}
-  .row:first-of-type {{ border-top:none }}
-  .pill {{ display:inline-flex; align-items:center; gap:8px; padding:4px 10px; border-radius:999px; font-weight:700; background:var(--chip) }}
-  .dot {{ width:8px; height:8px; border-radius:999px; display:inline-block }}
-  .status-out {{ color:var(--red); font-weight:800 }}
-  .status-in {{ color:var(--green); font-weight:800 }}
-  .turn {{ background:#ffedd5; color:#7c2d12; border:2px solid #fdba74; padding:3px 10px; border-radius:999px; font-weight:900; text-transform:uppercase; letter-spacing:.3px }}
-  .note {{ color:#666; }}
-  .btn {{ margin-left:auto; background:#1976d2; color:#fff; text-decoration:none; padding:8px 12px; border-radius:10px; font-weight:700 }}
-  .strike {{ text-decoration: line-through; color:#9aa1a9; }}
-  .done {{ background:#16a34a; color:#fff; padding:2px 8px; border-radius:999px; font-weight:800; font-size:12px }}
-  .tasks {{ display:grid; grid-template-columns: repeat(auto-fit, minmax(220px, 1fr)); gap:6px 14px; margin:10px 0 6px; }}
-  .tasks label {{ display:flex; align-items:center; gap:8px; font-size:14px; }}
-  .card{{ background:#fff; border-radius:14px; padding:16px; box-shadow:0 1px 2px rgba(0,0,0,.05); border:1px solid #eee; }}
-  .mono {{ font-family: ui-monospace,SFMono-Regular,Menlo,Monaco,Consolas,"Liberation Mono","Courier New",monospace; }}
-</style>
+  }
+  body { font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Inter,Arial; margin:24px; background:var(--bg); color:#111; }
+  h1 { margin:0 0 8px }
+  .legend { color:var(--muted); margin-bottom:12px }
+  .badges { display:flex; gap:8px; flex-wrap:wrap; margin-bottom:12px }
+  .counter-badge, .queue-badge { display:inline-flex; align-items:center; gap:8px; background:#fff; border:1px solid #eee; border-radius:12px; padding:6px 10px; font-weight:700; }
+  .counter-badge a, .queue-badge a { margin-left:8px; font-weight:600; font-size:13px }
+  .day { background:var(--card); border:1px solid #eee; border-radius:14px; padding:16px; margin:16px 0; box-shadow:0 2px 6px rgba(0,0,0,.04); }
+  .day h2 { margin:0 0 10px; display:flex; align-items:center; gap:10px }
+  .today { background:#111; color:#fff; font-size:12px; padding:3px 8px; border-radius:999px }
+  .row { display:flex; align-items:center; gap:12px; padding:10px 0; border-top:1px dashed #eee }
+  .row:first-of-type { border-top:none }
+  .pill { display:inline-flex; align-items:center; gap:8px; padding:4px 10px; border-radius:999px; font-weight:700; background:var(--chip) }
+  .dot { width:8px; height:8px; border-radius:999px; display:inline-block }
+  .status-out { color:var(--red); font-weight:800 }
+  .status-in { color:var(--green); font-weight:800 }
+  .turn { background:#ffedd5; color:#7c2d12; border:2px solid #fdba74; padding:3px 10px; border-radius:999px; font-weight:900; text-transform:uppercase; letter-spacing:.3px }
+  .note { color:#666; }
+  .btn { margin-left:auto; background:#1976d2; color:#fff; text-decoration:none; padding:8px 12px; border-radius:10px; font-weight:700 }
+  .strike { text-decoration: line-through; color:#9aa1a9; }
+  .done { background:#16a34a; color:#fff; padding:2px 8px; border-radius:999px; font-weight:800; font-size:12px }
+  .tasks { display:grid; grid-template-columns: repeat(auto-fit, minmax(220px, 1fr)); gap:6px 14px; margin:10px 0 6px; }
+  .tasks label { display:flex; align-items:center; gap:8px; font-size:14px; }
+  .card{ background:#fff; border-radius:14px; padding:16px; box-shadow:0 1px 2px rgba(0,0,0,.05); border:1px solid #eee; }
+  .mono { font-family: ui-monospace,SFMono-Regular,Menlo,Monaco,Consolas,"Liberation Mono","Courier New",monospace; }
 """
 
+# Written once into the /static mount; the content hash in the name lets browsers cache it safely
+APP_CSS_NAME = f"app.{hashlib.sha1(APP_CSS.encode()).hexdigest()[:10]}.css"
+with open(os.path.join(UPLOAD_DIR, APP_CSS_NAME), "w") as _css:
+    _css.write(APP_CSS)
+BASE_CSS = f'<link rel="stylesheet" href="/static/{APP_CSS_NAME}">'
+
 TASK_LABELS = [
     "Floors swept / vacuumed",
     "Floors mopped",
@@ -541,79 +1055,74 @@ TASK_LABELS = [
     "Toiletries & toilet roll restocked",
     "Final check (lights off, windows/doors locked)",
 ]
+TASKS_HTML = '<div class="tasks">' + "".join(
+    f'<label><input type="checkbox" name="tasks" value="{html.escape(label)}"> {html.escape(label)}</label>'
+    for label in TASK_LABELS
+) + "</div>"
 
-def html_page(body: str) -> str:
-    queue_ct = get_queue_count()
-    counter_html = f'<div class="counter-badge">✅ Cleans completed: <span>{get_counter()}</span> <a href="/counter">Admin</a></div>'
-    # Always show the queue badge, even when 0
-    queue_html = f'<div class="queue-badge">📦 Queued WA: <span>{queue_ct}</span> <a href="/queue">Manage</a></div>'
-    badges = f'<div class="badges">{counter_html}{queue_html}</div>'
-    return f"""<!doctype html>
+# Page shell is fixed after startup (CSS link, legend times), so it is built once
+_PAGE_HEAD = f"""<!doctype html>
 <html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
 <title>Cleaner Schedule</title>{BASE_CSS}</head>
 <body>
   <h1>Cleaner Schedule</h1>
   <div class="legend">Check-out in <span style="color:#d32f2f;font-weight:800">red</span> • Check-in in <span style="color:#2e7d32;font-weight:800">green</span> • <b>SAME-DAY</b> stands out • Clean {CLEAN_START}–{CLEAN_END}</div>
-  {badges}
-  {body}
-</body></html>"""
+  """.encode("utf-8")
+_PAGE_TAIL = b"\n</body></html>"
+
+def html_page(body: str) -> bytes:
+    """Full page as UTF-8 bytes; HTMLResponse sends bytes as-is, so the fixed shell is encoded only once."""
+    # Always show the queue badge, even when 0
+    badges = (
+        f'<div class="badges"><div class="counter-badge">✅ Cleans completed: <span>{get_counter()}</span> <a href="/counter">Admin</a></div>'
+        f'<div class="queue-badge">📦 Queued WA: <span>{get_queue_count()}</span> <a href="/queue">Manage</a></div></div>'
+    )
+    return b"".join((_PAGE_HEAD, badges.encode("utf-8"), b"\n  ", body.encode("utf-8"), _PAGE_TAIL))
+
+# Fixed row fragments: what follows the flat chip for each (check-out, check-in) combination
+_STATUS_HTML = {
+    (True, True): ' <span class="status-out">Check-out</span> <span class="turn">SAME-DAY TURNAROUND</span> ',
+    (True, False): ' <span class="status-out">Check-out</span> ',
+    (False, True): ' <span class="status-in">Check-in</span>',
+    (False, False): "",
+}
+_CLEAN_LINE = f'🧹 Clean between <b>{CLEAN_START}–{CLEAN_END}</b>'
+_CLEAN_TODO = f'<span class="note">{_CLEAN_LINE}</span> '
+_CLEAN_DONE = f'<span class="note strike">{_CLEAN_LINE}</span> '
+_DONE_BADGE = ' <span class="done">✔ Completed</span>'
+
+def _iter_schedule(sched: Dict[date, List[Dict]], today: date, done: Set[Tuple[str, str]]):
+    for d, items in sched.items():
+        day_iso = d.isoformat()
+        today_badge = ' <span class="today">TODAY</span>' if d == today else ""
+        yield f'<div class="day"><h2>{d.strftime("%a %d %b")}{today_badge}</h2>'
+        for it in items:
+            chip = f'<div class="row">{it["chip"]}'
+            status = _STATUS_HTML[(it["out"], it["in"])]
+            completed = (it["flat"], day_iso) in done
+            if not it["out"]:
+                yield f'{chip}{status}{_DONE_BADGE if completed else ""}</div>'
+                continue
+            href = f'/upload?flat={it["quoted"]}&amp;date={day_iso}'
+            if completed:
+                yield f'{chip}{status}{_CLEAN_DONE}<a class="btn" href="{href}">📷 Add more photos</a>{_DONE_BADGE}</div>'
+            else:
+                yield f'{chip}{status}{_CLEAN_TODO}<a class="btn" href="{href}">📷 Upload Photos</a></div>'
+        yield "</div>"
 
 def render_schedule(sched: Dict[date, List[Dict]], days: int) -> str:
     if not sched:
         longer = max(days, 30)
         return f'<p>No activity found. Try a longer window: <a href="/cleaner?days={longer}">/cleaner?days={longer}</a> or see <a href="/debug">/debug</a>.</p>'
-    today = datetime.utcnow().date()
-    parts: List[str] = []
-    for d, items in sched.items():
-        heading = d.strftime("%a %d %b")
-        today_badge = ' <span class="today">TODAY</span>' if d == today else ""
-        day_iso = d.isoformat()
-        parts.append(f'<div class="day"><h2>{heading}{today_badge}</h2>')
-        for it in items:
-            has_out = it["out"]
-            has_in = it["in"]
-            same_day = has_out and has_in
-            completed = is_completed(it["flat"], day_iso)
-
-            chip = f'<span class="pill"><span class="dot" style="background:{it["colour"]}"></span>{it["nick"]}</span>'
-            status_bits: List[str] = []
-            if has_out:
-                status_bits.append('<span class="status-out">Check-out</span>')
-            if has_in and not has_out:
-                status_bits.append('<span class="status-in">Check-in</span>')
-
-            turn = '<span class="turn">SAME-DAY TURNAROUND</span>' if same_day else ""
-
-            clean_html = ""
-            if has_out:
-                line = f'🧹 Clean between <b>{CLEAN_START}–{CLEAN_END}</b>'
-                cls = "note strike" if completed else "note"
-                clean_html = f'<span class="{cls}">{line}</span>'
-
-            btn = ""
-            if has_out:
-                upload_href = f'/upload?flat={it["flat"].replace(" ", "%20")}&date={day_iso}'
-                btn_text = "📷 Upload Photos" if not completed else "📷 Add more photos"
-                btn = f'<a class="btn" href="{upload_href}">{btn_text}</a>'
-
-            done_badge = ' <span class="done">✔ Completed</span>' if completed else ""
-
-            row = f'<div class="row">{chip} {" ".join(status_bits)} {turn} {clean_html} {btn}{done_badge}</div>'
-            parts.append(row)
-        parts.append("</div>")
-    return "\n".join(parts)
+    done = completed_for([(it["flat"], d.isoformat()) for d, items in sched.items() for it in items])
+    return "\n".join(_iter_schedule(sched, datetime.utcnow().date(), done))
 
 # ---------------------------
 # Routes
 # ---------------------------
-@app.get("/", response_class=PlainTextResponse)
-def root():
-    return "OK"
-
-# ----- Login / Logout -----
-@app.get("/login", response_class=HTMLResponse)
-def login_page():
-    return """
+# Both pages are fixed bytes; build the responses once and hand back the same object.
+_ROOT = PlainTextResponse("OK")
+_LOGIN_PAGE = HTMLResponse("""
     <!doctype html>
     <html>
     <head>
@@ -639,17 +1148,27 @@ def login_page():
       </div>
     </body>
     </html>
-    """
+    """)
+_TO_LOGIN = RedirectResponse(url="/login", status_code=303)
+
+@app.get("/", response_class=PlainTextResponse)
+def root():
+    return _ROOT
+
+# ----- Login / Logout -----
+@app.get("/login", response_class=HTMLResponse)
+def login_page():
+    return _LOGIN_PAGE
 
 @app.post("/login")
 async def login_submit(request: Request):
     form = await request.form()
     pw = (form.get("password") or "").strip()
-    if APP_PASSWORD and pw == APP_PASSWORD:
+    if APP_PASSWORD and hmac.compare_digest(pw.encode(), APP_PASSWORD.encode()):
         resp = RedirectResponse(url="/cleaner", status_code=303)
-        resp.set_cookie(SESSION_COOKIE, APP_PASSWORD, httponly=True, max_age=60*60*12, samesite="lax")
+        resp.set_cookie(SESSION_COOKIE, make_session_token(), httponly=True, max_age=SESSION_MAX_AGE, samesite="lax")
         return resp
-    return RedirectResponse(url="/login", status_code=303)
+    return _TO_LOGIN
 
 @app.get("/logout")
 def logout():
@@ -658,57 +1177,133 @@ def logout():
     return resp
 
 # ----- Protected pages -----
-@app.get("/cleaner", response_class=HTMLResponse)
-def cleaner(days: int = DEFAULT_DAYS, session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
-    schedule = build_schedule(days)
-    return HTMLResponse(html_page(render_schedule(schedule, days)))
-
-@app.get("/debug", response_class=PlainTextResponse)
-def debug(session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
+# Last rendered /cleaner page per ?days=, reused while nothing on it has changed:
+# days -> (key, page bytes, etag). The ETag hashes the page itself, so it stays valid across restarts.
+_RENDER_CACHE: Dict[int, Tuple[tuple, bytes, str]] = {}
+# Browsers may keep the page but must revalidate each time; an unchanged page is then a bodiless 304
+_CLEANER_CACHE_CONTROL = "private, no-cache"
+
+@app.get("/cleaner", response_class=HTMLResponse, dependencies=AUTH)
+def cleaner(request: Request, days: int = DEFAULT_DAYS):
+    refresh_feeds()
+    key = (datetime.utcnow().date(), _versions["ics"], marks_stamp(), get_counter(), get_queue_count())
+    hit = _RENDER_CACHE.get(days)
+    if hit and hit[0] == key:
+        page, etag = hit[1], hit[2]
+    else:
+        schedule = build_schedule(days)
+        page = html_page(render_schedule(schedule, days))
+        etag = f'"{hashlib.blake2b(page, digest_size=8).hexdigest()}"'
+        if len(_RENDER_CACHE) >= 16:
+            _RENDER_CACHE.clear()
+        _RENDER_CACHE[days] = (key, page, etag)
+    headers = {"ETag": etag, "Cache-Control": _CLEANER_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(page, headers=headers)
+
+@app.get("/debug", response_class=PlainTextResponse, dependencies=AUTH)
+def debug():
     flats = load_flats()
     lines = ["Loaded flats:"]
     for name, meta in flats.items():
         lines.append(f"  {name}: url={'SET' if meta['url'] else 'MISSING'} nick={meta['nick']} colour={meta['colour']}")
     schedule = build_schedule(14)
     lines.append("")
-    for flat in flats.keys():
-        tot = inn = outn = 0
-        for d, items in schedule.items():
-            for it in items:
-                if it["flat"] == flat:
-                    tot += 1
-                    if it["in"]: inn += 1
-                    if it["out"]: outn += 1
+    # one pass over the schedule: flat -> [total, in, out]
+    stats = {flat: [0, 0, 0] for flat in flats}
+    for items in schedule.values():
+        for it in items:
+            s = stats[it["flat"]]
+            s[0] += 1
+            s[1] += it["in"]
+            s[2] += it["out"]
+    for flat, (tot, inn, outn) in stats.items():
         lines.append(f"{flat}: total={tot} (in={inn}, out={outn})")
     lines.append(f"\nDays with activity in next 14 days: {len(schedule)}")
     return "\n".join(lines)
 
-# Serve uploaded media (public for Twilio)
-@app.get("/m/{fname}")
-def serve_media(fname: str):
-    path = os.path.join(UPLOAD_DIR, fname)
-    if not os.path.isfile(path):
-        raise HTTPException(status_code=404, detail="Not found")
-    mt = "image/jpeg"
-    lf = fname.lower()
-    if lf.endswith(".png"): mt = "image/png"
-    if lf.endswith(".webp"): mt = "image/webp"
-    if lf.endswith(".heic"): mt = "image/heic"
-    return FileResponse(path, media_type=mt)
+# HEIC decode + JPEG encode is CPU-bound; run it in worker processes, not on the event loop.
+# The pool is only created on the first HEIC upload (most deploys never get one), and its workers
+# are spawned rather than forked: by then this process runs several threads, and a forked child
+# would inherit their locks in whatever state they happened to be in.
+IMG_WORKERS = int(os.getenv("IMG_WORKERS", "2"))
+_IMG_POOL: Optional[ProcessPoolExecutor] = None
+_IMG_POOL_LOCK = threading.Lock()
+
+def _img_pool() -> ProcessPoolExecutor:
+    global _IMG_POOL
+    with _IMG_POOL_LOCK:
+        if _IMG_POOL is None:
+            _IMG_POOL = ProcessPoolExecutor(max_workers=IMG_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _IMG_POOL
+
+@app.on_event("shutdown")
+def _stop_img_pool() -> None:
+    if _IMG_POOL is not None:
+        _IMG_POOL.shutdown(wait=False, cancel_futures=True)
+
+# Blocking I/O started from async handlers (DB/SQLite writes, Twilio sends) gets its own threads,
+# so a burst of uploads doesn't queue behind everything else in the shared default threadpool
+IO_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("IO_WORKERS", "8")), thread_name_prefix="io")
+
+async def _in_io_pool(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(IO_POOL, fn, *args)
+
+def _heic_to_jpeg(src: str, dest: str) -> None:
+    img = Image.open(src)
+    # WhatsApp recompresses large media anyway; capping the size makes the encode and upload cheaper
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    img.convert("RGB").save(dest, format="JPEG", quality=90)
+
+UPLOAD_CHUNK = 1 << 20
+# Phone photos are a few MB; a single file far beyond that isn't kept (the request as a whole is
+# already capped by MAX_UPLOAD_MB before it reaches the handler)
+MAX_PHOTO_BYTES = int(os.getenv("MAX_PHOTO_MB", "25")) << 20
+
+def _copy_upload(src, dest: str) -> None:
+    size = src.seek(0, os.SEEK_END)
+    if size > MAX_PHOTO_BYTES:
+        raise ValueError(f"photo over {MAX_PHOTO_BYTES >> 20} MB")
+    src.seek(0)
+    with open(dest, "wb") as w:
+        shutil.copyfileobj(src, w, UPLOAD_CHUNK)
+
+async def _save_photo(f: UploadFile) -> Optional[str]:
+    try:
+        # Detect extension; convert HEIC -> JPG if possible
+        orig_name = (f.filename or "")
+        lf = orig_name.lower()
+        ext = ".jpg"
+        if lf.endswith(".png"):  ext = ".png"
+        elif lf.endswith(".webp"): ext = ".webp"
+        elif lf.endswith(".heic"): ext = ".heic"
+
+        # Save as-is first, copied in chunks off the event loop; the upload is never held in memory whole
+        fname = f"{uuid.uuid4().hex}{ext}"
+        dest = os.path.join(UPLOAD_DIR, fname)
+        await _in_io_pool(_copy_upload, f.file, dest)
+
+        # If HEIC and we have Pillow+pillow-heif, convert to JPG (the worker reads the saved file)
+        if ext == ".heic" and Image is not None:
+            jpg_name = f"{uuid.uuid4().hex}.jpg"
+            try:
+                await asyncio.get_running_loop().run_in_executor(_img_pool(), _heic_to_jpeg, dest, os.path.join(UPLOAD_DIR, jpg_name))
+                os.remove(dest)
+                fname = jpg_name
+                print(f"Converted HEIC -> JPG: {orig_name} -> {fname}")
+            except Exception as e:
+                # Fallback: keep the file as given (may not render in WA)
+                print("HEIC convert failed, saved raw:", repr(e))
+        return fname
+    except Exception as e:
+        print("Save file error:", repr(e))
+        return None
 
 # Upload flow: GET form + POST handler
-def _upload_form(flat: str, the_date: str, msg: str = "") -> str:
-    checks: List[str] = []
-    for i, label in enumerate(TASK_LABELS, start=1):
-        checks.append(f'<label><input type="checkbox" name="tasks" value="{label}"> {label}</label>')
-    tasks_html = '<div class="tasks">' + "".join(checks) + "</div>"
-    note = f'<p style="color:#2e7d32;font-weight:700">{msg}</p>' if msg else ""
-    return f"""<!doctype html>
-<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Upload</title>{BASE_CSS}</head>
+_UPLOAD_TMPL = (
+    """<!doctype html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Upload</title>""" + BASE_CSS + """</head>
 <body>
   <h1>Upload Photos</h1>
   {note}
@@ -725,14 +1320,18 @@ def _upload_form(flat: str, the_date: str, msg: str = "") -> str:
     </form>
   </div>
 </body></html>"""
+)
 
-@app.get("/upload", response_class=HTMLResponse)
-def upload_form(flat: str, date: str, session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
+def _upload_form(flat: str, the_date: str, msg: str = "") -> str:
+    note = f'<p style="color:#2e7d32;font-weight:700">{html.escape(msg)}</p>' if msg else ""
+    # flat/date come straight from the query string
+    return _UPLOAD_TMPL.format(note=note, flat=html.escape(flat), the_date=html.escape(the_date), tasks_html=TASKS_HTML)
+
+@app.get("/upload", response_class=HTMLResponse, dependencies=AUTH)
+def upload_form(flat: str, date: str):
     return HTMLResponse(_upload_form(flat, date))
 
-@app.post("/upload")
+@app.post("/upload", dependencies=AUTH)
 async def upload_submit(
     request: Request,
     flat: str = Form(...),
@@ -740,59 +1339,17 @@ async def upload_submit(
     notes: str = Form(""),
     tasks: List[str] = Form(None),  # multiple checkboxes named "tasks"
     photos: List[UploadFile] = File(default_factory=list),
-    session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE),
 ):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
-
     tasks = tasks or []
     tasks_line = ", ".join(tasks) if tasks else "None"
 
-    saved_urls: List[str] = []
-    for f in photos or []:
-        try:
-            # Detect extension; convert HEIC -> JPG if possible
-            orig_name = (f.filename or "")
-            lf = orig_name.lower()
-            ext = ".jpg"
-            if lf.endswith(".png"):  ext = ".png"
-            elif lf.endswith(".webp"): ext = ".webp"
-            elif lf.endswith(".heic"): ext = ".heic"
-
-            raw_bytes = await f.read()
-
-            # If HEIC and we have Pillow+pillow-heif, convert to JPG
-            if ext == ".heic" and Image is not None:
-                try:
-                    import io
-                    img = Image.open(io.BytesIO(raw_bytes))
-                    rgb = img.convert("RGB")
-                    fname = f"{uuid.uuid4().hex}.jpg"
-                    dest = os.path.join(UPLOAD_DIR, fname)
-                    rgb.save(dest, format="JPEG", quality=90)
-                    print(f"Converted HEIC -> JPG: {orig_name} -> {fname}")
-                except Exception as e:
-                    # Fallback: save as given (may not render in WA)
-                    fname = f"{uuid.uuid4().hex}{ext}"
-                    dest = os.path.join(UPLOAD_DIR, fname)
-                    with open(dest, "wb") as w:
-                        w.write(raw_bytes)
-                    print("HEIC convert failed, saved raw:", repr(e))
-            else:
-                # Non-HEIC (or no Pillow) -> save as-is
-                fname = f"{uuid.uuid4().hex}{ext}"
-                dest = os.path.join(UPLOAD_DIR, fname)
-                with open(dest, "wb") as w:
-                    w.write(raw_bytes)
-
-            base = PUBLIC_BASE_URL or f"{request.url.scheme}://{request.url.netloc}"
-            saved_urls.append(f"{base}/m/{fname}")
-        except Exception as e:
-            print("Save file error:", repr(e))
-            continue
+    # Photos are saved side by side; each returns its stored filename, or None if it failed
+    fnames = await asyncio.gather(*(_save_photo(f) for f in photos or []))
+    base = PUBLIC_BASE_URL or f"{request.url.scheme}://{request.url.netloc}"
+    saved_urls = [f"{base}/static/{fname}" for fname in fnames if fname]
 
     # Mark completion (counter persists via DB offset; no bump here)
-    set_completed(flat, date)
+    await _in_io_pool(set_completed, flat, date)
 
     # Build caption for freeform
     caption_lines = [
@@ -811,202 +1368,191 @@ async def upload_submit(
     if notes.strip():
         details_text += f" — Notes: {notes.strip()}"
 
-    # Try freeform media; if outside 24h, queue & send template asking to reply
-    wa_send_text_and_media_or_queue(caption, saved_urls if saved_urls else None, details_text)
+    # Try freeform media; if outside 24h, queue & send template asking to reply.
+    # Never blocks: the send runs on IO_POOL (or waits for the WA_BATCH_SECONDS flush),
+    # so the cleaner isn't kept waiting on Twilio.
+    wa_send_batched(caption, saved_urls if saved_urls else None, details_text)
 
     return RedirectResponse(url="/cleaner", status_code=303)
 
 # ---------------------------
 # Counter: admin page (+ / - / reset) with PIN
 # ---------------------------
+# Static page skeletons, built once: COUNTER_PASSWORD can't change after startup,
+# so only the live numbers are filled in per request.
+_PIN_FIELD = (
+    '<input type="password" name="pin" placeholder="PIN" '
+    'style="padding:8px;border:1px solid #ddd;border-radius:8px;min-width:120px" required>'
+) if COUNTER_PASSWORD else ""
+
+_COUNTER_BODY_TMPL = (
+    '<div class="card" style="max-width:640px">'
+    '<h2 style="margin-top:0">🧹 Cleans Completed Counter</h2>'
+    '<p style="font-weight:700">Current count: {count}</p>'
+    '{queue_note}'
+
+    # counter controls
+    '<form action="/counter/update" method="post" '
+    'style="display:flex;gap:10px;flex-wrap:wrap;align-items:center;margin-bottom:12px">'
+    f'{_PIN_FIELD}'
+    '<button type="submit" name="action" value="plus" '
+    'style="background:#16a34a;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">➕ Add 1</button>'
+    '<button type="submit" name="action" value="minus" '
+    'style="background:#f59e0b;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">➖ Subtract 1</button>'
+    '<button type="submit" name="action" value="reset" '
+    'style="background:#ef4444;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">🔁 Reset total</button>'
+    '</form>'
+
+    '<hr style="margin:14px 0;border:0;border-top:1px solid #eee">'
+
+    # reset completed marks
+    '<h3 style="margin:0 0 8px">Reset completed marks</h3>'
+    '<p class="legend" style="margin:6px 0 10px">'
+    'Choose a scope. For <b>Clear ALL</b>, you must type <code>CONFIRM</code>.'
+    '</p>'
+
+    '<form action="/completed/reset" method="post" '
+    'style="display:flex;gap:8px;flex-wrap:wrap;align-items:center">'
+    f'{_PIN_FIELD}'
+    '<input type="date" name="day" placeholder="YYYY-MM-DD" '
+    'style="padding:8px;border:1px solid #ddd;border-radius:8px">'
+    '<input type="text" name="flat" placeholder="Optional: Flat name (exact)" '
+    'style="padding:8px;border:1px solid #ddd;border-radius:8px">'
+    '<input type="text" name="confirm" placeholder="Type CONFIRM for Clear ALL" '
+    'style="padding:8px;border:1px solid #ddd;border-radius:8px;flex:1;min-width:220px">'
+    '<button type="submit" name="scope" value="day" '
+    'style="background:#0ea5e9;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">Clear day</button>'
+    '<button type="submit" name="scope" value="flat_day" '
+    'style="background:#6366f1;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">Clear flat+day</button>'
+    '<button type="submit" name="scope" value="all" '
+    'style="background:#ef4444;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">Clear ALL</button>'
+    '</form>'
+
+    '<div style="margin-top:14px"><a href="/cleaner">⬅ Back to schedule</a></div>'
+    '</div>'
+)
+
+_QUEUE_FORMS = (
+    '<form action="/queue/release" method="post" style="margin-top:12px;display:flex;gap:8px;flex-wrap:wrap;align-items:center">'
+    f'{_PIN_FIELD}'
+    '<button type="submit" style="background:#16a34a;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">▶️ Release now</button>'
+    '</form>'
+    '<form action="/queue/clear" method="post" style="margin-top:8px;display:flex;gap:8px;flex-wrap:wrap;align-items:center">'
+    f'{_PIN_FIELD}'
+    '<button type="submit" style="background:#ef4444;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">🗑 Clear queue</button>'
+    '</form>'
+    '<div style="margin-top:14px"><a href="/counter">⬅ Back to counter</a></div>'
+    '</div>'
+)
+
+# The admin POSTs always bounce back to a fixed page; a stateless response can be reused.
+# Don't add background tasks to these (FastAPI would attach them to the shared object).
+_TO_COUNTER = RedirectResponse(url="/counter", status_code=303)
+_TO_QUEUE = RedirectResponse(url="/queue", status_code=303)
+
+# {"count": N} is small enough to write by hand; skips the jsonable_encoder/json.dumps round trip
+_COUNTER_UNAUTH_JSON = b'{"count":0}'
+
 @app.get("/api/counter")
 def api_counter_value(session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
     if not check_auth(session_token):
-        return {"count": 0}
-    return {"count": get_counter()}
-
-@app.get("/counter", response_class=HTMLResponse)
-def counter_page(session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
+        return Response(content=_COUNTER_UNAUTH_JSON, media_type="application/json")
+    return Response(content=b'{"count":%d}' % get_counter(), media_type="application/json")
 
+@app.get("/counter", response_class=HTMLResponse, dependencies=AUTH)
+def counter_page():
     queue_ct = get_queue_count()
     queue_note = f'<p class="mono">📦 Queued WhatsApp sends: <b>{queue_ct}</b> — <a href="/queue">Manage queue</a></p>' if queue_ct > 0 else ""
 
-    # one reusable PIN input
-    pin_field = ""
-    if COUNTER_PASSWORD:
-        pin_field = (
-            '<input type="password" name="pin" placeholder="PIN" '
-            'style="padding:8px;border:1px solid #ddd;border-radius:8px;min-width:120px" required>'
-        )
-
-    body = (
-        '<div class="card" style="max-width:640px">'
-        '<h2 style="margin-top:0">🧹 Cleans Completed Counter</h2>'
-        f'<p style="font-weight:700">Current count: {get_counter()}</p>'
-        f'{queue_note}'
-
-        # counter controls
-        '<form action="/counter/update" method="post" '
-        'style="display:flex;gap:10px;flex-wrap:wrap;align-items:center;margin-bottom:12px">'
-        f'{pin_field}'
-        '<button type="submit" name="action" value="plus" '
-        'style="background:#16a34a;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">➕ Add 1</button>'
-        '<button type="submit" name="action" value="minus" '
-        'style="background:#f59e0b;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">➖ Subtract 1</button>'
-        '<button type="submit" name="action" value="reset" '
-        'style="background:#ef4444;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">🔁 Reset total</button>'
-        '</form>'
-
-        '<hr style="margin:14px 0;border:0;border-top:1px solid #eee">'
-
-        # reset completed marks
-        '<h3 style="margin:0 0 8px">Reset completed marks</h3>'
-        '<p class="legend" style="margin:6px 0 10px">'
-        'Choose a scope. For <b>Clear ALL</b>, you must type <code>CONFIRM</code>.'
-        '</p>'
-
-        '<form action="/completed/reset" method="post" '
-        'style="display:flex;gap:8px;flex-wrap:wrap;align-items:center">'
-        f'{pin_field}'
-        '<input type="date" name="day" placeholder="YYYY-MM-DD" '
-        'style="padding:8px;border:1px solid #ddd;border-radius:8px">'
-        '<input type="text" name="flat" placeholder="Optional: Flat name (exact)" '
-        'style="padding:8px;border:1px solid #ddd;border-radius:8px">'
-        '<input type="text" name="confirm" placeholder="Type CONFIRM for Clear ALL" '
-        'style="padding:8px;border:1px solid #ddd;border-radius:8px;flex:1;min-width:220px">'
-        '<button type="submit" name="scope" value="day" '
-        'style="background:#0ea5e9;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">Clear day</button>'
-        '<button type="submit" name="scope" value="flat_day" '
-        'style="background:#6366f1;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">Clear flat+day</button>'
-        '<button type="submit" name="scope" value="all" '
-        'style="background:#ef4444;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">Clear ALL</button>'
-        '</form>'
-
-        '<div style="margin-top:14px"><a href="/cleaner">⬅ Back to schedule</a></div>'
-        '</div>'
-    )
+    body = _COUNTER_BODY_TMPL.format(count=get_counter(), queue_note=queue_note)
     return HTMLResponse(html_page(body))
 
-@app.post("/completed/reset")
+@app.post("/completed/reset", dependencies=AUTH)
 def completed_reset(
     scope: str = Form(...),                 # "day" | "flat_day" | "all"
     day: str = Form(default=""),            # YYYY-MM-DD
     flat: str = Form(default=""),
     confirm: str = Form(default=""),        # must equal "CONFIRM" for scope=all
     pin: str = Form(default=""),
-    session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE),
 ):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
-
-    if COUNTER_PASSWORD and pin != COUNTER_PASSWORD:
-        return RedirectResponse(url="/counter", status_code=303)
+    if not check_pin(pin):
+        return _TO_COUNTER
 
-    if scope == "all":
-        if confirm.strip().upper() != "CONFIRM":
-            return RedirectResponse(url="/counter", status_code=303)
+    match scope:
+        case "flat_day" if day and flat:
+            clear_completed(day_iso=day, flat=flat)
+        case "day" if day:
+            clear_completed(day_iso=day)
+        case "all" if confirm.strip().upper() == "CONFIRM":
+            clear_completed()
 
-    if scope == "flat_day" and day and flat:
-        clear_completed(day_iso=day, flat=flat)
-    elif scope == "day" and day:
-        clear_completed(day_iso=day)
-    elif scope == "all":
-        clear_completed()
+    return _TO_COUNTER
 
-    return RedirectResponse(url="/counter", status_code=303)
+_COUNTER_ACTIONS = {"plus": (bump_counter, 1), "minus": (bump_counter, -1), "reset": (set_counter, 0)}
 
-@app.post("/counter/update")
+@app.post("/counter/update", dependencies=AUTH)
 def counter_update(
     action: str = Form(...),
     pin: str = Form(default=""),
-    session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE),
 ):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
-
-    if COUNTER_PASSWORD and pin != COUNTER_PASSWORD:
-        return RedirectResponse(url="/counter", status_code=303)
+    if not check_pin(pin):
+        return _TO_COUNTER
 
-    if action == "plus":
-        bump_counter(1)
-    elif action == "minus":
-        bump_counter(-1)
-    elif action == "reset":
-        set_counter(0)
+    fn, arg = _COUNTER_ACTIONS.get(action, (None, None))
+    if fn:
+        fn(arg)
 
-    return RedirectResponse(url="/counter", status_code=303)
+    return _TO_COUNTER
 
 # ---------------------------
 # Queue management UI (PIN-gated)
 # ---------------------------
-@app.get("/queue", response_class=HTMLResponse)
-def queue_page(session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
+def _first_media_link(media: List[str]) -> str:
+    if not media:
+        return ""
+    return f"• <a href='{html.escape(media[0])}' target='_blank'>first link</a>"
 
+@app.get("/queue", response_class=HTMLResponse, dependencies=AUTH)
+def queue_page():
     q = _load_queue()
-    items_html = []
-    if q:
-        for i, item in enumerate(q, start=1):
-            ts = item.get("ts", "")
-            cap = item.get("caption", "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-            media = item.get("media_urls", [])
-            first = media[0] if media else ""
-            items_html.append(
-                f'<div class="card"><div style="font-weight:700">#{i} — {ts}</div>'
-                f'<div class="mono" style="white-space:pre-wrap;margin:6px 0">{cap}</div>'
-                f'<div>Photos: <b>{len(media)}</b> {"• <a href=\''+first+'\' target=\'_blank\'>first link</a>" if first else ""}</div></div>'
-            )
-    else:
-        items_html.append('<p>No queued items.</p>')
-
-    pin_field = ""
-    if COUNTER_PASSWORD:
-        pin_field = (
-            '<input type="password" name="pin" placeholder="PIN" '
-            'style="padding:8px;border:1px solid #ddd;border-radius:8px;min-width:120px" required>'
-        )
-
-    body = (
+    parts = [
         '<div class="card" style="max-width:760px">'
         f'<h2 style="margin-top:0">📦 WhatsApp Queue ({len(q)})</h2>'
-        + "".join(items_html) +
-        '<form action="/queue/release" method="post" style="margin-top:12px;display:flex;gap:8px;flex-wrap:wrap;align-items:center">'
-        f'{pin_field}'
-        '<button type="submit" style="background:#16a34a;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">▶️ Release now</button>'
-        '</form>'
-        '<form action="/queue/clear" method="post" style="margin-top:8px;display:flex;gap:8px;flex-wrap:wrap;align-items:center">'
-        f'{pin_field}'
-        '<button type="submit" style="background:#ef4444;color:#fff;border:0;border-radius:10px;padding:10px 14px;font-weight:700">🗑 Clear queue</button>'
-        '</form>'
-        '<div style="margin-top:14px"><a href="/counter">⬅ Back to counter</a></div>'
-        '</div>'
-    )
-    return HTMLResponse(html_page(body))
-
-@app.post("/queue/release")
-def queue_release(pin: str = Form(default=""), session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
-    if COUNTER_PASSWORD and pin != COUNTER_PASSWORD:
-        return RedirectResponse(url="/queue", status_code=303)
-    _release_queue_and_send()
-    return RedirectResponse(url="/queue", status_code=303)
-
-@app.post("/queue/clear")
-def queue_clear(pin: str = Form(default=""), session_token: Optional[str] = Cookie(default=None, alias=SESSION_COOKIE)):
-    if not check_auth(session_token):
-        return RedirectResponse(url="/login")
-    if COUNTER_PASSWORD and pin != COUNTER_PASSWORD:
-        return RedirectResponse(url="/queue", status_code=303)
-    _save_queue([])
-    return RedirectResponse(url="/queue", status_code=303)
+    ]
+    for i, item in enumerate(q, start=1):
+        cap = html.escape(item.get("caption", ""), quote=False)
+        media = item.get("media_urls", [])
+        parts.append(
+            f'<div class="card"><div style="font-weight:700">#{i} — {item.get("ts", "")}</div>'
+            f'<div class="mono" style="white-space:pre-wrap;margin:6px 0">{cap}</div>'
+            f'<div>Photos: <b>{len(media)}</b> {_first_media_link(media)}</div></div>'
+        )
+    if not q:
+        parts.append('<p>No queued items.</p>')
+    parts.append(_QUEUE_FORMS)
+    return HTMLResponse(html_page("".join(parts)))
+
+@app.post("/queue/release", dependencies=AUTH)
+def queue_release(pin: str = Form(default="")):
+    if not check_pin(pin):
+        return _TO_QUEUE
+    # Twilio sends can take a while; answer first, send after the response is out
+    return RedirectResponse(url="/queue", status_code=303, background=BackgroundTask(_release_queue_and_send))
+
+@app.post("/queue/clear", dependencies=AUTH)
+def queue_clear(pin: str = Form(default="")):
+    if not check_pin(pin):
+        return _TO_QUEUE
+    _clear_queue()
+    return _TO_QUEUE
 
 # ---------------------------
 # Twilio WhatsApp inbound webhook (auto-release queue)
 # ---------------------------
+# A WhatsApp message body is at most 1600 chars; even fully percent-encoded
+# multi-byte text plus Twilio's other fields stays well under this.
+WA_INCOMING_MAX_BYTES = 32 * 1024
+
 @app.post("/wa/incoming")
 async def wa_incoming(request: Request):
     """
@@ -1014,20 +1560,30 @@ async def wa_incoming(request: Request):
     We treat ANY inbound message as consent to open the 24h window,
     then immediately release queued media.
     """
+    raw = bytearray()
+    async for chunk in request.stream():
+        raw += chunk
+        if len(raw) > WA_INCOMING_MAX_BYTES:
+            print("Inbound WA body too large, ignored")
+            return PlainTextResponse("OK")
     try:
-        form = await request.form()
+        # Twilio webhooks are always application/x-www-form-urlencoded
+        form = dict(parse_qsl(raw.decode("utf-8", "replace")))
         from_num = (form.get("From") or "")
         body = (form.get("Body") or "").strip()
         print(f"Incoming WA from {from_num}: {body!r}")
     except Exception as e:
         print("Inbound parse error:", repr(e))
 
-    _release_queue_and_send()
-    return PlainTextResponse("OK")
+    # Ack Twilio straight away (it retries slow webhooks); release runs after the response
+    return PlainTextResponse("OK", background=BackgroundTask(_release_queue_and_send))
 
 # ---------------------------
 # Local run
 # ---------------------------
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
+    # uvicorn[standard] brings uvloop + httptools, which uvicorn picks up automatically.
+    # Default to one worker: the render/feed caches and QUEUE_LOCK are per process.
+    uvicorn.run("app:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")),
+                workers=int(os.getenv("WEB_CONCURRENCY", "1")))
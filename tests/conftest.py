@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# app.py reads its config at import time; point it at throwaway local state
+os.environ.setdefault("APP_PASSWORD", "test-password")
+os.environ["LOCAL_DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="cleaner-tests-"), "cleaner.db")
+os.environ.pop("DATABASE_URL", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+@pytest.fixture
+def token():
+    return app.make_session_token()
+
+
+def test_fresh_token_is_accepted(token):
+    assert app.check_auth(token)
+
+
+def test_expired_token_is_rejected(monkeypatch, token):
+    expires = int(token.partition(".")[0])
+    monkeypatch.setattr(app.time, "time", lambda: expires + 1)
+    assert not app.check_auth(token)
+
+
+def test_tampered_signature_is_rejected(token):
+    expires, _, sig = token.partition(".")
+    flipped = sig[:-1] + ("0" if sig[-1] != "0" else "1")
+    assert not app.check_auth(f"{expires}.{flipped}")
+
+
+def test_extended_expiry_with_old_signature_is_rejected(token):
+    expires, _, sig = token.partition(".")
+    assert not app.check_auth(f"{int(expires) + 86400}.{sig}")
+
+
+@pytest.mark.parametrize("cookie", ["", "garbage", "123", ".abc", "12.é", "ünïcode.☃", app.APP_PASSWORD])
+def test_malformed_cookies_are_rejected(cookie):
+    assert not app.check_auth(cookie)
+
+
+def test_changing_app_password_invalidates_old_cookies(monkeypatch, token):
+    monkeypatch.setattr(app, "APP_PASSWORD", "a-new-password")
+    monkeypatch.setattr(app, "_SESSION_KEY", app._session_key("a-new-password", app.SESSION_SECRET))
+    assert not app.check_auth(token)
+    assert app.check_auth(app.make_session_token())
+
+
+def test_login_sets_a_signed_cookie_not_the_password():
+    client = TestClient(app.app)
+    resp = client.post("/login", data={"password": app.APP_PASSWORD}, follow_redirects=False)
+    assert resp.status_code == 303 and resp.headers["location"] == "/cleaner"
+    cookie = resp.cookies[app.SESSION_COOKIE]
+    assert app.APP_PASSWORD not in cookie
+    assert app.check_auth(cookie)
+
+    client.cookies.set(app.SESSION_COOKIE, cookie)
+    assert client.get("/counter", follow_redirects=False).status_code == 200
+    client.cookies.clear()
+    raw = f"{app.SESSION_COOKIE}=ünïcode".encode()   # a non-ASCII cookie must not turn into a 500
+    assert client.get("/counter", headers={"cookie": raw}, follow_redirects=False).status_code == 303
+
+
+def test_wrong_password_does_not_log_in():
+    resp = TestClient(app.app).post("/login", data={"password": "nope"}, follow_redirects=False)
+    assert resp.headers["location"] == "/login"
+    assert app.SESSION_COOKIE not in resp.cookies
@@ -0,0 +1,116 @@
+import types
+
+import pytest
+
+import app
+
+
+class OperationalError(Exception):
+    pass
+
+
+class InterfaceError(Exception):
+    pass
+
+
+class ProgrammingError(Exception):
+    pass
+
+
+class Conn:
+    def __init__(self, error=None):
+        self.error = error
+        self.autocommit = False
+        self.executed = []
+        self.closed = False
+
+    def cursor(self):
+        conn = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql, params=None):
+                if conn.error:
+                    raise conn.error
+                conn.executed.append(sql)
+
+            def fetchone(self):
+                return (1,)
+
+        return Cursor()
+
+    def close(self):
+        self.closed = True
+
+
+class Pool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.checkouts = 0
+        self.returned = []
+
+    def getconn(self):
+        self.checkouts += 1
+        return self.conn
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+
+@pytest.fixture
+def pg(monkeypatch):
+    """Fake psycopg2 + pool; set pg.pooled / pg.fresh to the connections to hand out."""
+    state = types.SimpleNamespace(pooled=Conn(), fresh=Conn(), connects=0)
+
+    def connect(dsn):
+        state.connects += 1
+        return state.fresh
+
+    fake = types.SimpleNamespace(OperationalError=OperationalError, InterfaceError=InterfaceError, connect=connect)
+    monkeypatch.setattr(app, "psycopg2", fake)
+    monkeypatch.setattr(app, "DATABASE_URL", "postgres://test")
+    monkeypatch.setattr(app, "_PG_STALE", (OperationalError, InterfaceError))
+    monkeypatch.setattr(app, "_DB_BREAKER", {"fail": 0, "open_until": 0.0})
+    state.pool = Pool(state.pooled)
+    monkeypatch.setattr(app, "_PG_POOL", state.pool)
+    return state
+
+
+def test_healthy_pooled_connection_is_reused(pg):
+    assert app._pg_exec("SELECT 1", fetch="one") == (1,)
+    assert pg.pool.returned == [(pg.pooled, False)]
+    assert pg.connects == 0
+
+
+@pytest.mark.parametrize("error", [OperationalError("server closed the connection"), InterfaceError("connection already closed")])
+def test_stale_pooled_connection_is_discarded_and_retried_once(pg, error):
+    pg.pooled.error = error
+    assert app._pg_exec("SELECT 1", fetch="one") == (1,)
+    assert pg.pool.checkouts == 1
+    assert pg.pool.returned == [(pg.pooled, True)]     # dropped from the pool, not handed out again
+    assert pg.connects == 1
+    assert pg.fresh.executed == ["SELECT 1"] and pg.fresh.closed
+    assert app._DB_BREAKER["fail"] == 0
+
+
+def test_retry_happens_only_once(pg):
+    pg.pooled.error = OperationalError("down")
+    pg.fresh.error = OperationalError("still down")
+    with pytest.raises(OperationalError):
+        app._pg_exec("SELECT 1")
+    assert pg.pool.checkouts == 1 and pg.connects == 1
+
+
+def test_query_errors_are_not_retried(pg):
+    pg.pooled.error = ProgrammingError("relation does not exist")
+    with pytest.raises(ProgrammingError):
+        app._pg_exec("SELECT * FROM missing")
+    assert pg.pool.checkouts == 1
+    assert pg.connects == 0
+    assert pg.pool.returned == [(pg.pooled, True)]
+    assert app._DB_BREAKER == {"fail": 0, "open_until": 0.0}
@@ -0,0 +1,91 @@
+from datetime import date
+
+import pytest
+import requests
+
+import app
+
+URL = "https://example.invalid/flat.ics"
+ICS = (
+    "BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nDTSTART;VALUE=DATE:20300101\r\n"
+    "DTEND;VALUE=DATE:20300104\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+).encode()
+SPANS = [(date(2030, 1, 1), date(2030, 1, 4))]
+
+
+class Resp:
+    def __init__(self, status_code, content=b""):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {"ETag": '"v1"'}
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    """Scripted feed host: queue responses (or exceptions) in feed.replies; feed.calls counts hits."""
+    class Feed:
+        replies = []
+        calls = 0
+        now = 1000.0
+
+        def get(self, url, headers=None, timeout=None):
+            self.calls += 1
+            reply = self.replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+        def advance(self, seconds):
+            self.now += seconds
+
+    f = Feed()
+    monkeypatch.setattr(app._HTTP, "get", f.get)
+    monkeypatch.setattr(app.time, "monotonic", lambda: f.now)
+    monkeypatch.setattr(app, "_ICS_CACHE", {})
+    monkeypatch.setattr(app, "_ICS_FAILED", {})
+    return f
+
+
+def test_failure_after_success_keeps_last_good_spans(feed):
+    feed.replies = [Resp(200, ICS), requests.ConnectionError("timeout")]
+    assert app.get_spans(URL) == SPANS
+    feed.advance(app.ICS_TTL + 1)
+    assert app.get_spans(URL) == SPANS      # the failing revalidation itself
+    feed.advance(1)
+    assert app.get_spans(URL) == SPANS      # and the negative-cache window after it
+    assert feed.calls == 2
+
+
+def test_feed_that_never_loaded_is_empty(feed):
+    feed.replies = [Resp(500)]
+    assert app.get_spans(URL) == []
+
+
+def test_failed_feed_is_not_retried_until_fail_retry_passes(feed):
+    feed.replies = [Resp(200, ICS), Resp(503), Resp(304)]
+    app.get_spans(URL)
+    feed.advance(app.ICS_TTL + 1)
+    app.get_spans(URL)
+    assert feed.calls == 2
+    feed.advance(app.ICS_FAIL_RETRY - 1)
+    app.get_spans(URL)
+    assert feed.calls == 2
+    feed.advance(2)
+    assert app.get_spans(URL) == SPANS
+    assert feed.calls == 3
+
+
+@pytest.mark.parametrize("recovery", [Resp(304), Resp(200, ICS)])
+def test_recovery_bumps_feed_version_once(feed, recovery):
+    feed.replies = [Resp(200, ICS), requests.ConnectionError("down"), recovery, Resp(304)]
+    app.get_spans(URL)
+    feed.advance(app.ICS_TTL + 1)
+    app.get_spans(URL)
+    before = app._versions["ics"]
+    feed.advance(app.ICS_FAIL_RETRY + 1)
+    assert app.get_spans(URL) == SPANS
+    assert app._versions["ics"] == before + 1
+    feed.advance(app.ICS_TTL + 1)
+    assert app.get_spans(URL) == SPANS      # a later, ordinary 304 changes nothing
+    assert app._versions["ics"] == before + 1
+    assert URL not in app._ICS_FAILED
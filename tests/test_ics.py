@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+
+import pytest
+
+import app
+
+
+def cal(*events: str) -> str:
+    body = "".join(f"BEGIN:VEVENT\r\n{e}END:VEVENT\r\n" for e in events)
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//test//EN\r\n{body}END:VCALENDAR\r\n"
+
+
+def icalendar_spans(monkeypatch, text):
+    """parse_bookings with the fast scanner disabled, i.e. the icalendar path."""
+    with monkeypatch.context() as m:
+        m.setattr(app, "parse_bookings_fast", lambda _: None)
+        return app.parse_bookings(text)
+
+
+FIXTURES = {
+    "all_day": cal(
+        "UID:1\r\nDTSTART;VALUE=DATE:20250301\r\nDTEND;VALUE=DATE:20250304\r\n",
+        "UID:2\r\nDTSTART;VALUE=DATE:20250304\r\nDTEND;VALUE=DATE:20250310\r\n",
+    ),
+    "datetimes": cal(
+        "UID:1\r\nDTSTART;TZID=Europe/London:20250301T150000\r\nDTEND;TZID=Europe/London:20250304T100000\r\n",
+        "UID:2\r\nDTSTART:20250305T140000Z\r\nDTEND:20250306T110000Z\r\n",
+        "UID:3\r\nDTSTART:20250307T140000\r\nDTEND;VALUE=DATE:20250309\r\n",
+    ),
+    "folded": cal(
+        "UID:1\r\nDTSTART;TZID=Eur\r\n ope/London:20250301T150000\r\nDTEND;VALUE=DATE:2025\r\n\t0304\r\n"
+        "SUMMARY:Reserved - a long summary that got\r\n  folded\r\n",
+    ),
+    "missing_dtend": cal(
+        "UID:1\r\nDTSTART;VALUE=DATE:20250301\r\n",
+        "UID:2\r\nDTSTART;VALUE=DATE:20250305\r\nDTEND;VALUE=DATE:20250307\r\n",
+    ),
+    "lf_only": cal("UID:1\r\nDTSTART;VALUE=DATE:20250301\r\nDTEND;VALUE=DATE:20250302\r\n").replace("\r\n", "\n"),
+    "no_events": cal(),
+}
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_fast_scanner_matches_icalendar(monkeypatch, name):
+    text = FIXTURES[name]
+    fast = app.parse_bookings_fast(text)
+    assert fast is not None
+    assert fast == icalendar_spans(monkeypatch, text)
+    assert app.parse_bookings(text) == fast
+
+
+def test_folded_dates_are_unfolded():
+    assert app.parse_bookings_fast(FIXTURES["folded"]) == [(date(2025, 3, 1), date(2025, 3, 4))]
+
+
+def test_missing_dtend_is_skipped():
+    assert app.parse_bookings_fast(FIXTURES["missing_dtend"]) == [(date(2025, 3, 5), date(2025, 3, 7))]
+
+
+@pytest.mark.parametrize("rule", ["RRULE:FREQ=WEEKLY;COUNT=3", "RDATE;VALUE=DATE:{later}"])
+def test_recurring_events_fall_back_to_icalendar(rule):
+    # near today, so the first occurrence is inside the window whether or not RRULE expansion is installed
+    start = date.today() + timedelta(days=1)
+    fmt = lambda d: d.strftime("%Y%m%d")
+    text = cal(f"UID:1\r\nDTSTART;VALUE=DATE:{fmt(start)}\r\nDTEND;VALUE=DATE:{fmt(start + timedelta(days=1))}\r\n"
+               f"{rule.format(later=fmt(start + timedelta(days=14)))}\r\n")
+    assert app.parse_bookings_fast(text) is None
+    assert (start, start + timedelta(days=1)) in app.parse_bookings(text)
+
+
+@pytest.mark.parametrize("text", [
+    cal("UID:1\r\nDTSTART;VALUE=DATE:2025\r\nDTEND;VALUE=DATE:20250302\r\n"),   # truncated date
+    cal("UID:1\r\nDTSTART;VALUE=DATE:20251399\r\nDTEND;VALUE=DATE:20250302\r\n"),  # invalid date
+    "BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nDTSTART;VALUE=DATE:20250301\r\n",  # unterminated VEVENT
+])
+def test_unfamiliar_input_defers_to_icalendar(text):
+    assert app.parse_bookings_fast(text) is None